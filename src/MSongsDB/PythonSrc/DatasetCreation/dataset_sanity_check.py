@@ -65,15 +65,13 @@ def sanity_check_1thread_wrapper(args):
 # actual function
 def sanity_check_1thread(maindir=None,threadid=-1,nthreads=-1,allfiles=[]):
     """
-    Main function, check a bunch of files by opening every field in
-    getter.
+    Main function, check a bunch of files by reading every field
+    of their song.
     """
     assert not maindir is None,'wrong param maindir'
     assert threadid>-1,'wrong param threadid'
     assert nthreads>0,'wrong param nthreads'
     assert len(allfiles)>0,'wrong param allfiles, or no files'
-    # get getters
-    getters = filter(lambda x: x[:4] == 'get_', GETTERS.__dict__.keys())
     # get the files to check
     files_per_thread = int(np.ceil(len(allfiles) * 1. / nthreads))
     p1 = files_per_thread * threadid
@@ -82,8 +80,8 @@ def sanity_check_1thread(maindir=None,threadid=-1,nthreads=-1,allfiles=[]):
     for f in allfiles[p1:p2]:
         try:
             h5 = GETTERS.open_h5_file_read(f)
-            for getter in getters:
-                tmp = GETTERS.__getattribute__(getter)(h5)
+            tmp = GETTERS.get_num_songs(h5)
+            tmp = GETTERS.read_song_record(h5)
         except KeyboardInterrupt:
             raise KeyboardInterruptError()
         except Exception,e:
@@ -60,10 +60,14 @@ def die_with_usage():
     print 'i.e. no beat/segment data, artist similarity, tags, ...'
     print ''
     print 'usage:'
-    print '   python create_summary_file.py <H5 DIR> <OUTPUT.h5>'
+    print '   python create_summary_file.py [FLAGS] <H5 DIR> <OUTPUT.h5>'
     print 'PARAMS'
     print '   H5 DIR     - directory contains h5 files (subdirs are checked)'
     print '   OUTPUT.h5  - filename of the summary file to create'
+    print 'FLAGS'
+    print '   --workers N - number of processes, each filling shards of the file'
+    print '                 that are then merged, 0 for one per core (default: 1)'
+    print '   --profile P - storage profile: '+', '.join(sorted(HDF5.STORAGE_PROFILES))
     sys.exit(0)
 
 
@@ -73,6 +77,22 @@ if __name__ == '__main__':
     if len(sys.argv)<3:
         die_with_usage()
 
+    # flags
+    nworkers = 1
+    profile = None
+    while True:
+        if sys.argv[1] == '--workers':
+            nworkers = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '--profile':
+            profile = sys.argv[2]
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+    if len(sys.argv)<3:
+        die_with_usage()
+
     # params
     maindir = sys.argv[1]
     output = sys.argv[2]
@@ -92,15 +112,19 @@ if __name__ == '__main__':
     allh5 = get_all_files(maindir,ext='.h5')
     print 'found',len(allh5),'H5 files.'
 
-    # create summary file
-    HDF5.create_aggregate_file(output,expectedrows=len(allh5),
-                               summaryfile=True)
-    print 'Summary file created, we start filling it.'
-
-    # fill it
-    h5 = HDF5.open_h5_file_append(output)
-    HDF5.fill_hdf5_aggregate_file(h5,allh5,summaryfile=True)
-    h5.close()
+    # create and fill the summary file, in parallel shards if asked
+    if nworkers != 1:
+        HDF5.create_aggregate_file_parallel(output,allh5,summaryfile=True,nworkers=nworkers,
+                                            profile=profile)
+    else:
+        HDF5.create_aggregate_file(output,expectedrows=len(allh5),
+                                   summaryfile=True,profile=profile)
+        print 'Summary file created, we start filling it.'
+
+        # fill it
+        h5 = HDF5.open_h5_file_append(output)
+        HDF5.fill_hdf5_aggregate_file_bulk(h5,allh5,summaryfile=True)
+        h5.close()
 
     # done!
     stimelength = str(datetime.timedelta(seconds=time.time()-t1))
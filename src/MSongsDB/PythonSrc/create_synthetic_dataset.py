@@ -0,0 +1,376 @@
+"""
+Creates a synthetic dataset in the Million Song Dataset format:
+song files in the usual A/B/C/TR....h5 layout (see path_from_trackid in
+DatasetCreation/dataset_creator.py), a track_metadata.db and an
+artist_term.db with the same tables as the real ones, and optionally an
+aggregate and a summary file.
+
+The values are random but realistic in shape (segments, beats, bars, tatums
+and sections follow the song tempo and duration), so the data can stand in
+for the real dataset when testing or benchmarking code that reads MSD files,
+e.g. on machines we can not ship the dataset to.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+"""
+
+import os
+import sys
+import time
+import datetime
+import sqlite3
+import numpy as np
+import hdf5_utils as HDF5
+
+
+# terms and musicbrainz tags we draw artist tags from
+TERMS = ['hip hop','rap','east coast rap','gangsta','soul','alternative rap',
+         'black','rock','pop','electronic','jazz','blues','country','funk',
+         'reggae','metal','indie','folk','house','techno']
+MBTAGS = ['hip hop','rap','american','rock','pop','soul','jazz','british']
+
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def path_from_trackid(trackid):
+    """
+    Returns the typical path, with the letters[2-3-4]
+    of the trackid (starting at 0), hence a song with
+    trackid: TRABC1839DQL4H... will have path:
+    A/B/C/TRABC1839DQL4H....h5
+    """
+    p = os.path.join(trackid[2],trackid[3])
+    p = os.path.join(p,trackid[4])
+    p = os.path.join(p,trackid+'.h5')
+    return p
+
+
+def random_id(rng,prefix,idx):
+    """
+    Returns an Echo Nest like ID (18 characters), e.g. TRABC12345678901234,
+    unique for a given prefix and index.
+    """
+    letters = ''.join(LETTERS[i] for i in rng.randint(len(LETTERS),size=3))
+    return prefix + letters + '%013d' % idx
+
+
+def create_artists(nartists,rng):
+    """
+    Returns a list of nartists random artists, each a dictionary
+    with its IDs, name, location, terms and musicbrainz tags.
+    """
+    artists = []
+    for idx in xrange(nartists):
+        nterms = rng.randint(3,8)
+        terms = [TERMS[i] for i in rng.permutation(len(TERMS))[:nterms]]
+        nmbtags = rng.randint(0,3)
+        mbtags = [MBTAGS[i] for i in rng.permutation(len(MBTAGS))[:nmbtags]]
+        artists.append({'artist_id': random_id(rng,'AR',idx),
+                        'artist_mbid': '%08x-0000-0000-0000-%012x' % (idx,idx),
+                        'artist_name': 'Artist %d' % idx,
+                        'artist_familiarity': rng.rand(),
+                        'artist_hotttnesss': rng.rand(),
+                        'artist_latitude': rng.uniform(-90,90),
+                        'artist_longitude': rng.uniform(-180,180),
+                        'artist_location': 'City %d' % (idx % 50),
+                        'terms': terms,
+                        'terms_freq': np.sort(rng.rand(nterms))[::-1],
+                        'terms_weight': np.sort(rng.rand(nterms))[::-1],
+                        'mbtags': mbtags,
+                        'mbtags_count': rng.randint(1,10,size=nmbtags)})
+    return artists
+
+
+def event_starts(rng,start,stop,nevents):
+    """
+    Returns nevents sorted start times, roughly evenly spaced between
+    start and stop, with some jitter.
+    """
+    if nevents <= 0:
+        return np.zeros(0)
+    step = (stop - start) / nevents
+    starts = start + step * np.arange(nevents)
+    starts[1:] += rng.uniform(-.2,.2,size=nevents-1) * step
+    return starts
+
+
+def fill_song_file(h5,trackid,artist,artists,rng,nsegs=900,nbeats=500):
+    """
+    Fill an open HDF5 song file (created by create_song_file) with
+    random values for all fields.
+    nsegs and nbeats are the mean number of segments and beats,
+    the actual numbers vary by +/- 20%.
+    """
+    nsegs = max(1,int(nsegs * rng.uniform(.8,1.2)))
+    nbeats = max(1,int(nbeats * rng.uniform(.8,1.2)))
+    tempo = rng.uniform(60,180)
+    time_signature = rng.choice([3,4,4,4,5])
+    end_of_fade_in = rng.uniform(0,2)
+    duration = end_of_fade_in + nbeats * 60. / tempo + rng.uniform(2,8)
+    # metadata
+    metadata = h5.root.metadata.songs
+    for key in ('artist_id','artist_mbid','artist_name','artist_familiarity',
+                'artist_hotttnesss','artist_latitude','artist_longitude',
+                'artist_location'):
+        getattr(metadata.cols,key)[0] = artist[key]
+    metadata.cols.artist_playmeid[0] = rng.randint(1,100000)
+    metadata.cols.artist_7digitalid[0] = rng.randint(1,100000)
+    metadata.cols.release[0] = 'Release %d' % rng.randint(10000)
+    metadata.cols.release_7digitalid[0] = rng.randint(1,1000000)
+    metadata.cols.song_id[0] = 'SO' + trackid[2:]
+    metadata.cols.song_hotttnesss[0] = rng.rand()
+    metadata.cols.title[0] = 'Song %s' % trackid[-6:]
+    metadata.cols.track_7digitalid[0] = rng.randint(1,10000000)
+    metadata.cols.idx_similar_artists[0] = 0
+    metadata.cols.idx_artist_terms[0] = 0
+    metadata.flush()
+    group = h5.root.metadata
+    similar = rng.permutation(len(artists))[:min(len(artists),rng.randint(5,100))]
+    group.similar_artists.append( np.array([artists[i]['artist_id'] for i in similar],dtype='string') )
+    group.artist_terms.append( np.array(artist['terms'],dtype='string') )
+    group.artist_terms_freq.append( artist['terms_freq'] )
+    group.artist_terms_weight.append( artist['terms_weight'] )
+    # analysis
+    analysis = h5.root.analysis.songs
+    analysis.cols.analysis_sample_rate[0] = 22050
+    analysis.cols.audio_md5[0] = '%032x' % rng.randint(2**31)
+    analysis.cols.duration[0] = duration
+    analysis.cols.end_of_fade_in[0] = end_of_fade_in
+    analysis.cols.key[0] = rng.randint(12)
+    analysis.cols.key_confidence[0] = rng.rand()
+    analysis.cols.loudness[0] = rng.uniform(-30,0)
+    analysis.cols.mode[0] = rng.randint(2)
+    analysis.cols.mode_confidence[0] = rng.rand()
+    analysis.cols.start_of_fade_out[0] = duration - rng.uniform(0,8)
+    analysis.cols.tempo[0] = tempo
+    analysis.cols.time_signature[0] = time_signature
+    analysis.cols.time_signature_confidence[0] = rng.rand()
+    analysis.cols.track_id[0] = trackid
+    for key in ('segments_start','segments_confidence','segments_pitches','segments_timbre',
+                'segments_loudness_max','segments_loudness_max_time','segments_loudness_start',
+                'sections_start','sections_confidence','beats_start','beats_confidence',
+                'bars_start','bars_confidence','tatums_start','tatums_confidence'):
+        getattr(analysis.cols,'idx_'+key)[0] = 0
+    analysis.flush()
+    group = h5.root.analysis
+    # segments
+    group.segments_start.append( event_starts(rng,0.,duration,nsegs) )
+    group.segments_confidence.append( rng.rand(nsegs) )
+    pitches = rng.rand(nsegs,12)
+    group.segments_pitches.append( pitches / pitches.max(axis=1).reshape(nsegs,1) )
+    timbre = rng.randn(nsegs,12) * 40
+    timbre[:,0] = rng.uniform(0,60,size=nsegs)
+    group.segments_timbre.append( timbre )
+    group.segments_loudness_max.append( rng.uniform(-60,0,size=nsegs) )
+    group.segments_loudness_max_time.append( rng.uniform(0,.3,size=nsegs) )
+    group.segments_loudness_start.append( rng.uniform(-60,-10,size=nsegs) )
+    # beats, bars every time_signature beats, 2 tatums per beat,
+    # sections every ~30 seconds
+    beats = event_starts(rng,end_of_fade_in,end_of_fade_in+nbeats*60./tempo,nbeats)
+    group.beats_start.append( beats )
+    group.beats_confidence.append( rng.rand(nbeats) )
+    bars = beats[::time_signature]
+    group.bars_start.append( bars )
+    group.bars_confidence.append( rng.rand(bars.shape[0]) )
+    tatums = np.sort(np.concatenate([beats,beats+30./tempo]))
+    group.tatums_start.append( tatums )
+    group.tatums_confidence.append( rng.rand(tatums.shape[0]) )
+    sections = event_starts(rng,0.,duration,max(1,int(duration/30.)))
+    group.sections_start.append( sections )
+    group.sections_confidence.append( rng.rand(sections.shape[0]) )
+    # musicbrainz
+    musicbrainz = h5.root.musicbrainz.songs
+    musicbrainz.cols.year[0] = rng.choice([0,rng.randint(1950,2011)])
+    musicbrainz.cols.idx_artist_mbtags[0] = 0
+    musicbrainz.flush()
+    group = h5.root.musicbrainz
+    group.artist_mbtags.append( np.array(artist['mbtags'],dtype='string') )
+    group.artist_mbtags_count.append( np.array(artist['mbtags_count'],dtype='int32') )
+
+
+def create_dbs(dbdir,songs,artists):
+    """
+    Creates track_metadata.db and artist_term.db in dbdir with the same
+    tables and indices as the real ones.
+    songs is a list of (trackid, artist index, title, release, duration,
+    year, track 7digital id)
+    """
+    # track metadata
+    conn = sqlite3.connect(os.path.join(dbdir,'track_metadata.db'))
+    q = 'CREATE TABLE songs (track_id text PRIMARY KEY, '
+    q += 'title text, song_id text, '
+    q += 'release text, artist_id text, artist_mbid text, artist_name text, '
+    q += 'duration real, artist_familiarity real, '
+    q += 'artist_hotttnesss real, year int, '
+    q += 'track_7digitalid int, shs_perf int, shs_work int)'
+    conn.execute(q)
+    rows = []
+    for trackid,aidx,title,release,duration,year,track7digital in songs:
+        a = artists[aidx]
+        rows.append((trackid,title,'SO'+trackid[2:],release,a['artist_id'],a['artist_mbid'],
+                     a['artist_name'],duration,a['artist_familiarity'],
+                     a['artist_hotttnesss'],year,track7digital,-1,0))
+    conn.executemany('INSERT INTO songs VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',rows)
+    conn.execute("CREATE INDEX idx_artist_id ON songs ('artist_id','release')")
+    conn.execute("CREATE INDEX idx_title ON songs ('title','artist_name','release')")
+    conn.commit()
+    conn.close()
+    # artist terms
+    conn = sqlite3.connect(os.path.join(dbdir,'artist_term.db'))
+    conn.execute("CREATE TABLE artists (artist_id text PRIMARY KEY)")
+    conn.execute("CREATE TABLE terms (term text PRIMARY KEY)")
+    q = "CREATE TABLE artist_term (artist_id text, term text, "
+    q += "FOREIGN KEY(artist_id) REFERENCES artists(artist_id), "
+    q += "FOREIGN KEY(term) REFERENCES terms(term) )"
+    conn.execute(q)
+    conn.execute("CREATE TABLE mbtags (mbtag text PRIMARY KEY)")
+    q = "CREATE TABLE artist_mbtag (artist_id text, mbtag text, "
+    q += "FOREIGN KEY(artist_id) REFERENCES artists(artist_id), "
+    q += "FOREIGN KEY(mbtag) REFERENCES mbtags(mbtag) )"
+    conn.execute(q)
+    conn.executemany("INSERT INTO artists VALUES (?)",
+                     sorted((a['artist_id'],) for a in artists))
+    conn.executemany("INSERT INTO terms VALUES (?)",[(t,) for t in sorted(TERMS)])
+    conn.executemany("INSERT INTO mbtags VALUES (?)",[(t,) for t in sorted(MBTAGS)])
+    conn.executemany("INSERT INTO artist_term VALUES (?,?)",
+                     [(art['artist_id'],t) for art in artists for t in art['terms']])
+    conn.executemany("INSERT INTO artist_mbtag VALUES (?,?)",
+                     [(art['artist_id'],t) for art in artists for t in art['mbtags']])
+    conn.execute("CREATE INDEX idx_artist_id_term ON artist_term ('artist_id','term')")
+    conn.execute("CREATE INDEX idx_term_artist_id ON artist_term ('term','artist_id')")
+    conn.execute("CREATE INDEX idx_artist_id_mbtag ON artist_mbtag ('artist_id','mbtag')")
+    conn.execute("CREATE INDEX idx_mbtag_artist_id ON artist_mbtag ('mbtag','artist_id')")
+    conn.commit()
+    conn.close()
+
+
+def create_synthetic_dataset(maindir,nsongs,nartists=None,nsegs=900,nbeats=500,seed=0):
+    """
+    Creates a synthetic dataset of nsongs songs in maindir:
+      maindir/data/A/B/C/TR....h5  - song files
+      maindir/AdditionalFiles/     - track_metadata.db and artist_term.db
+    nartists defaults to one artist for every 10 songs, nsegs and nbeats
+    are the mean number of segments and beats per song.
+    Returns the list of song files created.
+    """
+    rng = np.random.RandomState(seed)
+    if nartists is None:
+        nartists = max(1,nsongs / 10)
+    datadir = os.path.join(maindir,'data')
+    dbdir = os.path.join(maindir,'AdditionalFiles')
+    for d in (datadir,dbdir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    artists = create_artists(nartists,rng)
+    songs = []
+    allh5 = []
+    for idx in xrange(nsongs):
+        trackid = random_id(rng,'TR',idx)
+        aidx = rng.randint(nartists)
+        h5path = os.path.join(datadir,path_from_trackid(trackid))
+        if not os.path.isdir(os.path.dirname(h5path)):
+            os.makedirs(os.path.dirname(h5path))
+        HDF5.create_song_file(h5path,force=True)
+        h5 = HDF5.open_h5_file_append(h5path)
+        fill_song_file(h5,trackid,artists[aidx],artists,rng,nsegs=nsegs,nbeats=nbeats)
+        songs.append((trackid,aidx,HDF5.get_title(h5),HDF5.get_release(h5),
+                      float(HDF5.get_duration(h5)),int(HDF5.get_year(h5)),
+                      int(HDF5.get_track_7digitalid(h5))))
+        h5.close()
+        allh5.append(h5path)
+    create_dbs(dbdir,songs,artists)
+    return allh5
+
+
+def die_with_usage():
+    """ HELP MENU """
+    print 'create_synthetic_dataset.py'
+    print ''
+    print 'Creates a random dataset in the Million Song Dataset format:'
+    print 'song files in the A/B/C/TR....h5 layout, track_metadata.db and'
+    print 'artist_term.db, and optionally an aggregate and a summary file.'
+    print ''
+    print 'usage:'
+    print '   python create_synthetic_dataset.py [FLAGS] <OUTPUT DIR> <NSONGS>'
+    print 'PARAMS'
+    print '   OUTPUT DIR  - directory to create the dataset in'
+    print '   NSONGS      - number of song files to create'
+    print 'FLAGS'
+    print '   -nartists N - number of artists (default: NSONGS / 10)'
+    print '   -nsegs N    - mean number of segments per song (default: 900)'
+    print '   -nbeats N   - mean number of beats per song (default: 500)'
+    print '   -seed N     - random seed (default: 0)'
+    print '   -aggregate  - also create OUTPUT DIR/msd_aggregate.h5'
+    print '   -summary    - also create OUTPUT DIR/msd_summary_file.h5'
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+
+    # help menu
+    if len(sys.argv) < 3:
+        die_with_usage()
+
+    # flags
+    nartists = None
+    nsegs = 900
+    nbeats = 500
+    seed = 0
+    aggregate = False
+    summary = False
+    while True:
+        if sys.argv[1] == '-nartists':
+            nartists = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-nsegs':
+            nsegs = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-nbeats':
+            nbeats = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-seed':
+            seed = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-aggregate':
+            aggregate = True
+        elif sys.argv[1] == '-summary':
+            summary = True
+        else:
+            break
+        sys.argv.pop(1)
+
+    # params
+    maindir = sys.argv[1]
+    nsongs = int(sys.argv[2])
+
+    # sanity checks
+    if os.path.isdir(os.path.join(maindir,'data')):
+        print 'ERROR: directory',os.path.join(maindir,'data'),'exists, delete or provide a new directory.'
+        sys.exit(0)
+
+    # start time
+    t1 = time.time()
+
+    # create songs and databases
+    allh5 = create_synthetic_dataset(maindir,nsongs,nartists=nartists,
+                                     nsegs=nsegs,nbeats=nbeats,seed=seed)
+    print 'created',len(allh5),'song files and the SQLite databases.'
+
+    # aggregate / summary files
+    for wanted,filename,summaryfile in ((aggregate,'msd_aggregate.h5',False),
+                                        (summary,'msd_summary_file.h5',True)):
+        if not wanted:
+            continue
+        output = os.path.join(maindir,filename)
+        HDF5.create_aggregate_file(output,expectedrows=len(allh5),
+                                   summaryfile=summaryfile,force=True)
+        h5 = HDF5.open_h5_file_append(output)
+        HDF5.fill_hdf5_aggregate_file_bulk(h5,allh5,summaryfile=summaryfile)
+        h5.close()
+        print 'created',output
+
+    # done!
+    stimelength = str(datetime.timedelta(seconds=time.time()-t1))
+    print 'Created the synthetic dataset in:',stimelength
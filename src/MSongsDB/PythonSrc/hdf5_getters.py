@@ -28,15 +28,82 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 
+import os
+import collections
 import tables
+import numpy as np
 
 
+# process-local cache of open files, see set_h5_cache_size
+_h5_cache = collections.OrderedDict()
+_h5_cache_size = 0
+_h5_cache_pid = None
+
+
+class CachedH5File(object):
+    """
+    An open HDF5 file from the cache of open_h5_file_read.
+    close() leaves it open in the cache, the file is really closed when
+    it is evicted or when the cache is cleared.
+    Other attributes are the ones of the tables.File.
+    """
+    def __init__(self,h5,stat):
+        self.h5 = h5
+        self.stat = stat
+
+    def __getattr__(self,name):
+        return getattr(self.h5,name)
+
+    def close(self):
+        pass
+
+
+def set_h5_cache_size(size):
+    """
+    Set how many files open_h5_file_read keeps open, in this process,
+    so that opening one of them again costs nothing. Least recently
+    opened files are closed first. 0 disables the cache (the default).
+    A file must not be used anymore once that many other files were opened.
+    """
+    global _h5_cache_size
+    _h5_cache_size = size
+    while len(_h5_cache) > _h5_cache_size:
+        _h5_cache.popitem(last=False)[1].h5.close()
+
+def clear_h5_cache():
+    """
+    Close all the files in the cache of open_h5_file_read
+    """
+    while len(_h5_cache) > 0:
+        _h5_cache.popitem(last=False)[1].h5.close()
+
 def open_h5_file_read(h5filename):
     """
     Open an existing H5 in read mode.
     Same function as in hdf5_utils, here so we avoid one import
-    """
-    return tables.openFile(h5filename, mode='r')
+    If the cache is enabled (see set_h5_cache_size), return the file
+    from the cache if it is there and did not change on disk.
+    """
+    global _h5_cache_pid
+    if _h5_cache_size <= 0:
+        return tables.openFile(h5filename, mode='r')
+    # files opened by a parent process can not be used after a fork
+    if _h5_cache_pid != os.getpid():
+        _h5_cache.clear()
+        _h5_cache_pid = os.getpid()
+    key = os.path.abspath(h5filename)
+    st = os.stat(key)
+    stat = (st.st_mtime,st.st_size)
+    h5 = _h5_cache.pop(key,None)
+    if h5 is not None and h5.stat != stat:
+        h5.h5.close()
+        h5 = None
+    if h5 is None:
+        h5 = CachedH5File(tables.openFile(h5filename, mode='r'),stat)
+    _h5_cache[key] = h5
+    while len(_h5_cache) > _h5_cache_size:
+        _h5_cache.popitem(last=False)[1].h5.close()
+    return h5
 
 
 def get_num_songs(h5):
@@ -148,6 +215,8 @@ def get_similar_artists(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('similar_artists',songidx)
     if h5.root.metadata.songs.nrows == songidx + 1:
         return h5.root.metadata.similar_artists[h5.root.metadata.songs.cols.idx_similar_artists[songidx]:]
     return h5.root.metadata.similar_artists[h5.root.metadata.songs.cols.idx_similar_artists[songidx]:
@@ -159,6 +228,8 @@ def get_artist_terms(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('artist_terms',songidx)
     if h5.root.metadata.songs.nrows == songidx + 1:
         return h5.root.metadata.artist_terms[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:]
     return h5.root.metadata.artist_terms[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:
@@ -170,6 +241,8 @@ def get_artist_terms_freq(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('artist_terms_freq',songidx)
     if h5.root.metadata.songs.nrows == songidx + 1:
         return h5.root.metadata.artist_terms_freq[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:]
     return h5.root.metadata.artist_terms_freq[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:
@@ -181,6 +254,8 @@ def get_artist_terms_weight(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('artist_terms_weight',songidx)
     if h5.root.metadata.songs.nrows == songidx + 1:
         return h5.root.metadata.artist_terms_weight[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:]
     return h5.root.metadata.artist_terms_weight[h5.root.metadata.songs.cols.idx_artist_terms[songidx]:
@@ -288,6 +363,8 @@ def get_segments_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_start[h5.root.analysis.songs.cols.idx_segments_start[songidx]:]
     return h5.root.analysis.segments_start[h5.root.analysis.songs.cols.idx_segments_start[songidx]:
@@ -299,6 +376,8 @@ def get_segments_confidence(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_confidence',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_confidence[h5.root.analysis.songs.cols.idx_segments_confidence[songidx]:]
     return h5.root.analysis.segments_confidence[h5.root.analysis.songs.cols.idx_segments_confidence[songidx]:
@@ -310,6 +389,8 @@ def get_segments_pitches(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_pitches',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_pitches[h5.root.analysis.songs.cols.idx_segments_pitches[songidx]:,:]
     return h5.root.analysis.segments_pitches[h5.root.analysis.songs.cols.idx_segments_pitches[songidx]:
@@ -321,6 +402,8 @@ def get_segments_timbre(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_timbre',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_timbre[h5.root.analysis.songs.cols.idx_segments_timbre[songidx]:,:]
     return h5.root.analysis.segments_timbre[h5.root.analysis.songs.cols.idx_segments_timbre[songidx]:
@@ -332,6 +415,8 @@ def get_segments_loudness_max(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_loudness_max',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_loudness_max[h5.root.analysis.songs.cols.idx_segments_loudness_max[songidx]:]
     return h5.root.analysis.segments_loudness_max[h5.root.analysis.songs.cols.idx_segments_loudness_max[songidx]:
@@ -343,6 +428,8 @@ def get_segments_loudness_max_time(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_loudness_max_time',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_loudness_max_time[h5.root.analysis.songs.cols.idx_segments_loudness_max_time[songidx]:]
     return h5.root.analysis.segments_loudness_max_time[h5.root.analysis.songs.cols.idx_segments_loudness_max_time[songidx]:
@@ -354,6 +441,8 @@ def get_segments_loudness_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('segments_loudness_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.segments_loudness_start[h5.root.analysis.songs.cols.idx_segments_loudness_start[songidx]:]
     return h5.root.analysis.segments_loudness_start[h5.root.analysis.songs.cols.idx_segments_loudness_start[songidx]:
@@ -365,6 +454,8 @@ def get_sections_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('sections_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.sections_start[h5.root.analysis.songs.cols.idx_sections_start[songidx]:]
     return h5.root.analysis.sections_start[h5.root.analysis.songs.cols.idx_sections_start[songidx]:
@@ -376,6 +467,8 @@ def get_sections_confidence(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('sections_confidence',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.sections_confidence[h5.root.analysis.songs.cols.idx_sections_confidence[songidx]:]
     return h5.root.analysis.sections_confidence[h5.root.analysis.songs.cols.idx_sections_confidence[songidx]:
@@ -387,6 +480,8 @@ def get_beats_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('beats_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.beats_start[h5.root.analysis.songs.cols.idx_beats_start[songidx]:]
     return h5.root.analysis.beats_start[h5.root.analysis.songs.cols.idx_beats_start[songidx]:
@@ -398,6 +493,8 @@ def get_beats_confidence(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('beats_confidence',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.beats_confidence[h5.root.analysis.songs.cols.idx_beats_confidence[songidx]:]
     return h5.root.analysis.beats_confidence[h5.root.analysis.songs.cols.idx_beats_confidence[songidx]:
@@ -409,6 +506,8 @@ def get_bars_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('bars_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.bars_start[h5.root.analysis.songs.cols.idx_bars_start[songidx]:]
     return h5.root.analysis.bars_start[h5.root.analysis.songs.cols.idx_bars_start[songidx]:
@@ -420,6 +519,8 @@ def get_bars_confidence(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('bars_confidence',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.bars_confidence[h5.root.analysis.songs.cols.idx_bars_confidence[songidx]:]
     return h5.root.analysis.bars_confidence[h5.root.analysis.songs.cols.idx_bars_confidence[songidx]:
@@ -431,6 +532,8 @@ def get_tatums_start(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('tatums_start',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.tatums_start[h5.root.analysis.songs.cols.idx_tatums_start[songidx]:]
     return h5.root.analysis.tatums_start[h5.root.analysis.songs.cols.idx_tatums_start[songidx]:
@@ -442,6 +545,8 @@ def get_tatums_confidence(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('tatums_confidence',songidx)
     if h5.root.analysis.songs.nrows == songidx + 1:
         return h5.root.analysis.tatums_confidence[h5.root.analysis.songs.cols.idx_tatums_confidence[songidx]:]
     return h5.root.analysis.tatums_confidence[h5.root.analysis.songs.cols.idx_tatums_confidence[songidx]:
@@ -453,6 +558,8 @@ def get_artist_mbtags(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('artist_mbtags',songidx)
     if h5.root.musicbrainz.songs.nrows == songidx + 1:
         return h5.root.musicbrainz.artist_mbtags[h5.root.musicbrainz.songs.cols.idx_artist_mbtags[songidx]:]
     return h5.root.musicbrainz.artist_mbtags[h5.root.metadata.songs.cols.idx_artist_mbtags[songidx]:
@@ -464,6 +571,8 @@ def get_artist_mbtags_count(h5,songidx=0):
     file. By default, return the array for the first song in the h5 file.
     To get a regular numpy ndarray, cast the result to: numpy.array( )
     """
+    if isinstance(h5,IndexedH5):
+        return h5.read_array('artist_mbtags_count',songidx)
     if h5.root.musicbrainz.songs.nrows == songidx + 1:
         return h5.root.musicbrainz.artist_mbtags_count[h5.root.musicbrainz.songs.cols.idx_artist_mbtags[songidx]:]
     return h5.root.musicbrainz.artist_mbtags_count[h5.root.metadata.songs.cols.idx_artist_mbtags[songidx]:
@@ -474,3 +583,320 @@ def get_year(h5,songidx=0):
     Get release year from a HDF5 song file, by default the first song in it
     """
     return h5.root.musicbrainz.songs.cols.year[songidx]
+
+
+# scalar fields of a song (getter names without 'get_') by the table
+# they are a column of, in the order of the getters above
+METADATA_FIELDS = ('artist_familiarity','artist_hotttnesss','artist_id','artist_mbid',
+                   'artist_playmeid','artist_7digitalid','artist_latitude','artist_longitude',
+                   'artist_location','artist_name','release','release_7digitalid','song_id',
+                   'song_hotttnesss','title','track_7digitalid')
+ANALYSIS_FIELDS = ('analysis_sample_rate','audio_md5','danceability','duration','end_of_fade_in',
+                   'energy','key','key_confidence','loudness','mode','mode_confidence',
+                   'start_of_fade_out','tempo','time_signature','time_signature_confidence',
+                   'track_id')
+MUSICBRAINZ_FIELDS = ('year',)
+TABLE_FIELDS = {'metadata': METADATA_FIELDS,
+                'analysis': ANALYSIS_FIELDS,
+                'musicbrainz': MUSICBRAINZ_FIELDS}
+
+# groups of fields that can be asked for by name in read_fields
+FIELD_GROUPS = {'metadata': METADATA_FIELDS,
+                'artist_terms': ('similar_artists','artist_terms','artist_terms_freq',
+                                 'artist_terms_weight'),
+                'analysis': ANALYSIS_FIELDS,
+                'segments': ('segments_start','segments_confidence','segments_pitches',
+                             'segments_timbre','segments_loudness_max',
+                             'segments_loudness_max_time','segments_loudness_start'),
+                'sections': ('sections_start','sections_confidence'),
+                'rhythm': ('beats_start','beats_confidence','bars_start','bars_confidence',
+                           'tatums_start','tatums_confidence'),
+                'musicbrainz': ('year','artist_mbtags','artist_mbtags_count')}
+ALL_FIELDS = sum((FIELD_GROUPS[g] for g in ('metadata','artist_terms','analysis','segments',
+                                            'sections','rhythm','musicbrainz')), ())
+
+# array fields: the group they are in and the index column (in that group's
+# songs table) where each song's part of the array starts
+ARRAY_FIELDS = {'similar_artists': ('metadata','idx_similar_artists'),
+                'artist_terms': ('metadata','idx_artist_terms'),
+                'artist_terms_freq': ('metadata','idx_artist_terms'),
+                'artist_terms_weight': ('metadata','idx_artist_terms'),
+                'artist_mbtags': ('musicbrainz','idx_artist_mbtags'),
+                'artist_mbtags_count': ('musicbrainz','idx_artist_mbtags')}
+for f in FIELD_GROUPS['segments'] + FIELD_GROUPS['sections'] + FIELD_GROUPS['rhythm']:
+    ARRAY_FIELDS[f] = ('analysis','idx_'+f)
+del f
+
+
+def expand_fields(fields=None):
+    """
+    Return the field names for a list of field and/or group names
+    (see FIELD_GROUPS), all fields by default.
+    Raise a ValueError on an unknown name.
+    """
+    if fields is None:
+        return list(ALL_FIELDS)
+    expanded = []
+    for name in fields:
+        if name in FIELD_GROUPS:
+            names = FIELD_GROUPS[name]
+        elif name in ALL_FIELDS:
+            names = (name,)
+        else:
+            raise ValueError('unknown field or field group: '+name)
+        expanded.extend(n for n in names if n not in expanded)
+    return expanded
+
+def _read_song_rows(group,songidx):
+    """
+    Read the row of a song in the songs table of a group, and the next
+    row if any, which tells where the song's arrays stop.
+    """
+    nrows = group.songs.nrows
+    if songidx < 0:
+        songidx += nrows
+    if songidx < 0 or songidx >= nrows:
+        raise IndexError('song index out of range')
+    return group.songs.read(songidx,songidx+2)
+
+def _read_song_array(group,field,rows):
+    """
+    Read the part of an array field belonging to a song, given
+    the rows from _read_song_rows
+    """
+    idxname = ARRAY_FIELDS[field][1]
+    array = getattr(group,field)
+    if len(rows) > 1:
+        return array[rows[0][idxname]:rows[1][idxname]]
+    return array[rows[0][idxname]:]
+
+def read_fields(h5,fields=None,songidx=0):
+    """
+    Get a dictionary of fields from a HDF5 song file, by default the first song in it.
+    fields is a list of field names (getter names without 'get_', e.g. 'tempo')
+    and/or group names (e.g. 'metadata', 'segments', see FIELD_GROUPS),
+    all fields by default.
+    Everything is read in a single pass: the song's row (and the next one,
+    for where its arrays stop) of each table holding requested fields,
+    then one slice per requested array field.
+    """
+    fields = expand_fields(fields)
+    res = {}
+    for tablename,tablefields in TABLE_FIELDS.items():
+        wanted = [f for f in tablefields if f in fields]
+        arrays = [f for f in fields if ARRAY_FIELDS.get(f,('',))[0] == tablename]
+        if len(wanted) == 0 and len(arrays) == 0:
+            continue
+        group = getattr(h5.root,tablename)
+        rows = _read_song_rows(group,songidx)
+        for f in wanted:
+            res[f] = rows[0][f]
+        for f in arrays:
+            res[f] = _read_song_array(group,f,rows)
+    return res
+
+class SongRecord(object):
+    """
+    All the fields of one song, as attributes named like the getters
+    without 'get_' (e.g. record.tempo, record.segments_timbre).
+    Uses __slots__, many records can be kept in memory.
+    """
+    __slots__ = ALL_FIELDS
+
+    def __init__(self,**fields):
+        for f in self.__slots__:
+            setattr(self,f,fields.get(f))
+
+    def as_dict(self):
+        """ return the fields as a dictionary """
+        return dict((f,getattr(self,f)) for f in self.__slots__)
+
+
+def read_song_record(h5,songidx=0):
+    """
+    Get a SongRecord with all the fields of a song from a HDF5 song file
+    or an aggregate file, by default the first song in it.
+    All the fields are read in a single pass, see read_fields.
+    """
+    return SongRecord(**read_fields(h5,songidx=songidx))
+
+
+class Song(object):
+    """
+    A lazy view of one song of a HDF5 song file or aggregate file.
+    The scalar fields (e.g. song.tempo, song.year) are read when the view
+    is created, with one read per table. Each array field (e.g.
+    song.segments_timbre) is read on first access only, with a single
+    slice of the array, and kept for the next accesses.
+    The file must stay open until the arrays needed are read.
+    """
+    def __init__(self,h5,songidx=0):
+        self.h5 = h5
+        self.songidx = songidx
+        self._rows = {}
+        for tablename,tablefields in TABLE_FIELDS.items():
+            rows = _read_song_rows(getattr(h5.root,tablename),songidx)
+            self._rows[tablename] = rows
+            for f in tablefields:
+                setattr(self,f,rows[0][f])
+
+    def __getattr__(self,name):
+        # only called for attributes not set yet, i.e. arrays not read yet
+        if not name in ARRAY_FIELDS:
+            raise AttributeError(name)
+        groupname = ARRAY_FIELDS[name][0]
+        value = _read_song_array(getattr(self.h5.root,groupname),name,self._rows[groupname])
+        setattr(self,name,value)
+        return value
+
+    def loaded_arrays(self):
+        """ return the names of the array fields read so far """
+        return [f for f in ARRAY_FIELDS if f in self.__dict__]
+
+    def as_record(self):
+        """ return a SongRecord of the song, reading all the arrays """
+        return SongRecord(**dict((f,getattr(self,f)) for f in ALL_FIELDS))
+
+
+def read_song(h5,songidx=0):
+    """
+    Get a lazy Song view of a song from a HDF5 song file or an aggregate
+    file, by default the first song in it.
+    """
+    return Song(h5,songidx)
+
+
+def _batch_range(nrows,songidxs):
+    """
+    Returns (start, stop, positions) for a batch of songs given as None
+    (all songs), a slice or an array of song indices: the contiguous range
+    of rows to read, and the positions of the songs within that range.
+    """
+    if songidxs is None:
+        songidxs = slice(None)
+    if isinstance(songidxs,slice):
+        start,stop,step = songidxs.indices(nrows)
+        if step == 1:
+            return start,max(start,stop),np.arange(max(0,stop-start))
+        songidxs = np.arange(start,stop,step)
+    songidxs = np.asarray(songidxs,dtype=np.int64)
+    songidxs = np.where(songidxs < 0,songidxs + nrows,songidxs)
+    if len(songidxs) == 0:
+        return 0,0,songidxs
+    if songidxs.min() < 0 or songidxs.max() >= nrows:
+        raise IndexError('song index out of range')
+    start = songidxs.min()
+    return start,songidxs.max()+1,songidxs-start
+
+
+def read_scalar_batch(h5,field,songidxs=None):
+    """
+    Get a scalar field (e.g. 'tempo', 'year', 'artist_name') for many songs
+    of an aggregate or summary file, as a numpy array.
+    songidxs is a slice or an array of song indices, all songs by default.
+    The column is read with a single bulk read.
+    """
+    for tablename,tablefields in TABLE_FIELDS.items():
+        if field in tablefields:
+            break
+    else:
+        raise ValueError('unknown scalar field: '+field)
+    table = getattr(h5.root,tablename).songs
+    start,stop,positions = _batch_range(table.nrows,songidxs)
+    values = table.read(start,stop,field=field)
+    if len(positions) == stop - start:
+        return values
+    return values[positions]
+
+
+def read_array_batch(h5,field,songidxs=None):
+    """
+    Get an array field (e.g. 'segments_timbre', 'beats_start') for many songs
+    of an aggregate file, as a (values, offsets) pair: the arrays of all the
+    songs concatenated, and an int64 array of len(songs)+1 offsets, i.e.
+    song i of the batch is values[offsets[i]:offsets[i+1]].
+    songidxs is a slice or an array of song indices, all songs by default.
+    The index column and the array are each read with a single bulk read.
+    """
+    if field not in ARRAY_FIELDS:
+        raise ValueError('unknown array field: '+field)
+    groupname,idxname = ARRAY_FIELDS[field]
+    group = getattr(h5.root,groupname)
+    table = group.songs
+    array = getattr(group,field)
+    start,stop,positions = _batch_range(table.nrows,songidxs)
+    # where each song starts and stops in the array
+    bounds = np.empty(stop-start+1,dtype=np.int64)
+    bounds[:-1] = table.read(start,stop,field=idxname)
+    if stop < table.nrows:
+        bounds[-1] = table.read(stop,stop+1,field=idxname)[0]
+    else:
+        bounds[-1] = array.nrows
+    starts = bounds[:-1][positions]
+    stops = bounds[1:][positions]
+    lengths = stops - starts
+    offsets = np.zeros(len(positions)+1,dtype=np.int64)
+    np.cumsum(lengths,out=offsets[1:])
+    # one read covering all requested songs
+    base = bounds[0]
+    block = array[base:bounds[-1]]
+    if len(positions) == stop - start and (len(positions) < 2 or (positions[1:] > positions[:-1]).all()):
+        return block,offsets
+    take = np.arange(offsets[-1]) - np.repeat(offsets[:-1],lengths) + np.repeat(starts-base,lengths)
+    return block[take],offsets
+
+
+class IndexedH5(object):
+    """
+    An opened HDF5 song file (usually an aggregate file) with all its idx_*
+    columns loaded once in memory, so that finding the part of an array
+    field belonging to a song costs no read, and getting that array
+    a single read of the array.
+    Attributes that are not defined here (root, close, filename, ...) are
+    the ones of the wrapped file, so all the getters accept it as well,
+    and the array getters use its index.
+    """
+    def __init__(self,h5):
+        self.h5 = h5
+        self._arrays = {}
+        self._bounds = {}
+        for field,(groupname,idxname) in ARRAY_FIELDS.items():
+            group = getattr(h5.root,groupname)
+            self._arrays[field] = getattr(group,field)
+            if idxname not in self._bounds:
+                # song i is in [bounds[i], bounds[i+1]), the last song
+                # goes until the end of the array
+                bounds = np.empty(group.songs.nrows+1,dtype=np.int64)
+                bounds[:-1] = group.songs.read(field=idxname)
+                bounds[-1] = self._arrays[field].nrows
+                self._bounds[idxname] = bounds
+        self._idxnames = dict((f,i) for f,(g,i) in ARRAY_FIELDS.items())
+
+    def __getattr__(self,name):
+        return getattr(self.h5,name)
+
+    def song_range(self,field,songidx=0):
+        """
+        Return (start, stop) of a song in the array of an array field
+        """
+        bounds = self._bounds[self._idxnames[field]]
+        nsongs = len(bounds) - 1
+        if songidx < 0:
+            songidx += nsongs
+        if songidx < 0 or songidx >= nsongs:
+            raise IndexError('song index out of range')
+        return int(bounds[songidx]),int(bounds[songidx+1])
+
+    def read_array(self,field,songidx=0):
+        """
+        Get an array field (e.g. 'segments_timbre') of a song, with a single read
+        """
+        start,stop = self.song_range(field,songidx)
+        return self._arrays[field][start:stop]
+
+
+def open_h5_file_indexed(h5filename):
+    """
+    Open an existing H5 in read mode, as an IndexedH5
+    """
+    return IndexedH5(open_h5_file_read(h5filename))
@@ -0,0 +1,296 @@
+"""
+This code exports arrays of many HDF5 song files (e.g. segments_timbre,
+beats_start) to flat NumPy files, and reads them back memory-mapped.
+
+For each array field, all the songs' arrays are concatenated along the
+first axis in <field>.values.npy, and <field>.offsets.npy holds len(songs)+1
+int64 offsets: song i is values[offsets[i]:offsets[i+1]].
+track_id.npy and duration.npy hold one value per song, in the same order.
+manifest.json is written last and lists all of them, so a half written
+export is never read. It is the columnar format of Util.py, so
+Util.load_columnar can read it as well.
+
+Reading a song is then a slice of a memory-mapped file, no HDF5 file
+has to be opened, and a pass over all songs reads the files sequentially.
+
+This is part of the Million Song Dataset project from
+LabROSA (Columbia University) and The Echo Nest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import glob
+import json
+import datetime
+import numpy as np
+# project code
+import hdf5_getters
+
+
+# arrays exported by default, what beat-aligned features need
+NPY_FIELDS = ('segments_timbre','segments_pitches','segments_start','beats_start')
+# one value per song, always exported
+NPY_SCALAR_FIELDS = ('track_id','duration')
+MANIFEST = 'manifest.json'
+# size of the .npy headers we write, so they can be rewritten in place
+# once the number of rows is known
+NPY_HEADER_SIZE = 128
+
+
+def get_all_files(basedir,ext='.h5') :
+    """
+    From a root directory, go through all subdirectories
+    and find all files with the given extension.
+    Return all absolute paths in a list.
+    """
+    allfiles = []
+    for root, dirs, files in os.walk(basedir):
+        files = glob.glob(os.path.join(root,'*'+ext))
+        for f in files :
+            allfiles.append( os.path.abspath(f) )
+    return allfiles
+
+
+def write_npy_header(f,dtype,shape):
+    """
+    Write a .npy (version 1.0) header at the start of an open file,
+    padded to NPY_HEADER_SIZE bytes
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)),tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    if len(header) != NPY_HEADER_SIZE - 10:
+        raise ValueError('npy header too long for shape '+str(shape))
+    f.seek(0)
+    f.write(np.lib.format.MAGIC_PREFIX + chr(1) + chr(0))
+    f.write(np.array(len(header),dtype='<u2').tostring())
+    f.write(header)
+
+
+class NpyAppender(object):
+    """
+    Write a .npy file by appending blocks of rows to it, without
+    knowing the final number of rows in advance
+    """
+    def __init__(self,path,dtype,rowshape):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.rowshape = tuple(rowshape)
+        self.nrows = 0
+        self.f = open(path,'wb')
+        write_npy_header(self.f,self.dtype,(0,)+self.rowshape)
+
+    def append(self,values):
+        """ append rows, cast to the dtype of the file """
+        values = np.ascontiguousarray(values,dtype=self.dtype)
+        self.f.write(values.tostring())
+        self.nrows += values.shape[0]
+
+    def close(self):
+        """ write the final shape in the header and close """
+        write_npy_header(self.f,self.dtype,(self.nrows,)+self.rowshape)
+        self.f.close()
+
+
+def export_npy(h5_filenames,outdir,fields=NPY_FIELDS,bufsize=1000):
+    """
+    Export array fields of HDF5 song files (or aggregate files) to
+    flat .npy files in outdir, see the top of this file for the layout.
+    Songs are in the order of the files, and of the songs in each file.
+    Aggregate files are read bufsize songs at a time.
+    The dtype of each field is the one of the first file.
+    RETURN
+       number of songs exported
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # remove a previous manifest, the export is not valid until done
+    if os.path.isfile(os.path.join(outdir,MANIFEST)):
+        os.remove(os.path.join(outdir,MANIFEST))
+    writers = {}
+    lengths = dict((f,[]) for f in fields)
+    scalars = dict((f,[]) for f in NPY_SCALAR_FIELDS)
+    try:
+        for h5filename in h5_filenames:
+            h5 = hdf5_getters.open_h5_file_read(h5filename)
+            try:
+                nSongs = hdf5_getters.get_num_songs(h5)
+                for start in xrange(0,nSongs,bufsize):
+                    songidxs = slice(start,min(start+bufsize,nSongs))
+                    for field in NPY_SCALAR_FIELDS:
+                        scalars[field].append(hdf5_getters.read_scalar_batch(h5,field,songidxs))
+                    for field in fields:
+                        values,offsets = hdf5_getters.read_array_batch(h5,field,songidxs)
+                        if not field in writers:
+                            writers[field] = NpyAppender(os.path.join(outdir,field+'.values.npy'),
+                                                         values.dtype,values.shape[1:])
+                        writers[field].append(values)
+                        lengths[field].append(np.diff(offsets))
+            finally:
+                h5.close()
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return finish_npy_export(outdir,scalars,lengths,fields)
+
+
+def finish_npy_export(outdir,scalars,lengths,fields,extra=None):
+    """
+    Write the per song values, the offsets of the array fields
+    and the manifest of an export, once its .values.npy files are written.
+    scalars maps each of NPY_SCALAR_FIELDS to a list of arrays of values,
+    lengths maps each array field to a list of arrays of lengths,
+    both in the order of the songs.
+    extra holds more entries for the manifest, e.g. how values were computed.
+    RETURN
+       number of songs exported
+    """
+    nrows = sum(len(l) for l in scalars['track_id'])
+    columns = []
+    for field in NPY_SCALAR_FIELDS:
+        if nrows > 0:
+            values = np.concatenate(scalars[field])
+        else:
+            values = np.array([])
+        np.save(os.path.join(outdir,field+'.npy'),values)
+        columns.append({'name':field,'kind':'scalar'})
+    for field in fields:
+        offsets = np.zeros(nrows+1,dtype=np.int64)
+        if nrows > 0:
+            np.cumsum(np.concatenate(lengths[field]),out=offsets[1:])
+        else:
+            NpyAppender(os.path.join(outdir,field+'.values.npy'),np.float64,()).close()
+        np.save(os.path.join(outdir,field+'.offsets.npy'),offsets)
+        columns.append({'name':field,'kind':'ragged'})
+    # manifest last
+    manifest = dict(extra or {})
+    manifest.update({'nrows':nrows,'columns':columns})
+    f = open(os.path.join(outdir,MANIFEST),'w')
+    json.dump(manifest,f,indent=1)
+    f.close()
+    return nrows
+
+
+class NpyDataset(object):
+    """
+    Read an export of export_npy. Arrays are memory-mapped, and each song's
+    array is a view into them, nothing is copied or read before it is used.
+    Songs are accessed by position (0 to len-1) or by track_id.
+    """
+    def __init__(self,path):
+        self.path = path
+        f = open(os.path.join(path,MANIFEST))
+        manifest = json.load(f)
+        f.close()
+        self.manifest = manifest
+        self.nrows = manifest['nrows']
+        self.fields = [c['name'] for c in manifest['columns'] if c['kind'] == 'ragged']
+        self.track_ids = np.load(os.path.join(path,'track_id.npy'))
+        self.durations = np.load(os.path.join(path,'duration.npy'))
+        self._values = {}
+        self._offsets = {}
+        self._positions = None
+
+    def __len__(self):
+        return self.nrows
+
+    def load(self,field):
+        """
+        Return the (values, offsets) of an array field, values memory-mapped:
+        song i is values[offsets[i]:offsets[i+1]]
+        """
+        if not field in self._values:
+            if not field in self.fields:
+                raise KeyError('field not exported: '+field)
+            self._values[field] = np.load(os.path.join(self.path,field+'.values.npy'),
+                                          mmap_mode='r')
+            self._offsets[field] = np.load(os.path.join(self.path,field+'.offsets.npy'))
+        return self._values[field],self._offsets[field]
+
+    def position(self,track_id):
+        """ position of a song from its track_id, raise KeyError if unknown """
+        if self._positions is None:
+            self._positions = dict((tid,i) for i,tid in enumerate(self.track_ids))
+        return self._positions[track_id]
+
+    def get(self,field,idx):
+        """
+        Get an array field of a song, by position or track_id,
+        as a read-only view
+        """
+        if isinstance(idx,basestring):
+            idx = self.position(idx)
+        values,offsets = self.load(field)
+        return values[offsets[idx]:offsets[idx+1]]
+
+    def iter_field(self,field):
+        """ yield (track_id, array) of an array field for all songs, in order """
+        values,offsets = self.load(field)
+        for i in xrange(self.nrows):
+            yield self.track_ids[i],values[offsets[i]:offsets[i+1]]
+
+
+def die_with_usage():
+    """ HELP MENU """
+    print 'hdf5_to_npy.py'
+    print 'Export arrays of HDF5 song files (or aggregate files) to flat'
+    print 'NumPy files that can be memory-mapped, see NpyDataset to read them.'
+    print ' '
+    print 'usage:'
+    print '   python hdf5_to_npy.py [FLAGS] <DIR/FILE> <OUTPUT DIR>'
+    print 'PARAM'
+    print '   <DIR/FILE>    an aggregate file, or a dir with .h5 files in its subdirectories'
+    print '   <OUTPUT DIR>  where to write the .npy files'
+    print 'FLAGS'
+    print '   -fields F1,F2  array fields to export, default: '+','.join(NPY_FIELDS)
+    sys.exit(0)
+
+if __name__ == '__main__':
+
+    # HELP MENU
+    if len(sys.argv) < 3:
+        die_with_usage()
+
+    # FLAGS
+    fields = NPY_FIELDS
+    while True:
+        if sys.argv[1] == '-fields':
+            fields = sys.argv[2].split(',')
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+    for field in fields:
+        if not field in hdf5_getters.ARRAY_FIELDS:
+            print 'unknown array field:',field
+            sys.exit(0)
+
+    # GET DIR/FILE
+    if os.path.isfile(sys.argv[1]):
+        allh5files = [ os.path.abspath(sys.argv[1]) ]
+    elif os.path.isdir(sys.argv[1]):
+        allh5files = sorted(get_all_files(sys.argv[1],ext='.h5'))
+    else:
+        print 'file or dir:',sys.argv[1],'does not exist.'
+        sys.exit(0)
+    outdir = sys.argv[2]
+
+    # let's go!
+    t1 = time.time()
+    nrows = export_npy(allh5files,outdir,fields=fields)
+    stimelength = str(datetime.timedelta(seconds=time.time()-t1))
+    print 'exported',nrows,'songs from',len(allh5files),'files to',outdir,'in',stimelength
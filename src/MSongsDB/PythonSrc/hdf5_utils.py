@@ -29,6 +29,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import sys
+import shutil
+import tempfile
+import multiprocessing
 import numpy as np
 # code relies on pytables, see http://www.pytables.org
 import tables
@@ -65,6 +68,22 @@ ARRAY_DESC_TATUMS_CONFIDENCE = 'array of confidence of tatums'
 ARRAY_DESC_ARTIST_MBTAGS = 'array of tags from MusicBrainz for an artist'
 ARRAY_DESC_ARTIST_MBTAGS_COUNT = 'array of tag counts from MusicBrainz for an artist'
 
+# storage profiles for the files we create, by name:
+# - complib / complevel / shuffle: compression of tables and arrays,
+#   zlib is used if the compression library is not available
+# - float32_segments: store the segments_* arrays as float32
+# - chunkrows: rows per chunk of the arrays, capped by their expected number
+#   of rows, None to let PyTables choose from the expected number of rows
+# 'default' is how files have always been created
+STORAGE_PROFILES = {'default': {'complib':'zlib','complevel':1,'shuffle':True,
+                                'float32_segments':False,'chunkrows':None},
+                    'archival': {'complib':'zlib','complevel':9,'shuffle':True,
+                                 'float32_segments':False,'chunkrows':None},
+                    'fast-read': {'complib':'blosc','complevel':1,'shuffle':True,
+                                  'float32_segments':False,'chunkrows':4096},
+                    'compact': {'complib':'blosc','complevel':9,'shuffle':True,
+                                'float32_segments':True,'chunkrows':None}}
+
 
 def fill_hdf5_from_artist(h5,artist):
     """
@@ -363,7 +382,189 @@ def fill_hdf5_aggregate_file(h5,h5_filenames,summaryfile=False):
         h5tocopy.close()
 
 
-def create_song_file(h5filename,title='H5 Song File',force=False,complevel=1):
+def fill_hdf5_aggregate_file_bulk(h5,h5_filenames,summaryfile=False,bufsize=1000):
+    """
+    Same as fill_hdf5_aggregate_file, but reads the tables and arrays of
+    each HDF5 file wholesale instead of one getter call per field and song.
+    The indices (e.g. idx_segments_start) are shifted all at once, and
+    rows and arrays are buffered in memory and appended every bufsize
+    songs, so the aggregate file is written in big blocks.
+    Files with bufsize songs or more (e.g. other aggregate files) have
+    their arrays copied block by block instead, to bound memory.
+    The songs, fields and indices written are the same as with
+    fill_hdf5_aggregate_file, so the getters return the same data.
+    If summaryfile=True, we skip arrays (indices all 0)
+    """
+    groupnames = ('metadata','analysis','musicbrainz')
+    # buffered rows per table, buffered arrays per array field
+    rows = dict((g,[]) for g in groupnames)
+    arrays = dict((f,[]) for f in ARRAY_FIELDS)
+    # length of each array in the aggregate file, buffered data included
+    lengths = {}
+    if not summaryfile:
+        for field,(groupname,idxname) in ARRAY_FIELDS.items():
+            lengths[field] = getattr(getattr(h5.root,groupname),field).nrows
+    def flush():
+        for groupname in groupnames:
+            if len(rows[groupname]) > 0:
+                table = getattr(h5.root,groupname).songs
+                table.append(np.concatenate(rows[groupname]))
+                table.flush()
+                rows[groupname] = []
+        for field,(groupname,idxname) in ARRAY_FIELDS.items():
+            if len(arrays[field]) > 0:
+                getattr(getattr(h5.root,groupname),field).append(np.concatenate(arrays[field]))
+                arrays[field] = []
+    nbuffered = 0
+    for h5filename in h5_filenames:
+        h5tocopy = open_h5_file_read(h5filename)
+        try:
+            nSongs = get_num_songs(h5tocopy)
+            bigfile = nSongs >= bufsize
+            # arrays of a big file, copied once its rows are written
+            bigarrays = []
+            for groupname in groupnames:
+                table = getattr(h5.root,groupname).songs
+                # new rows, with default values for the fields we do not copy
+                newrows = np.zeros(nSongs,dtype=table.dtype)
+                oldrows = getattr(h5tocopy.root,groupname).songs.read()
+                for field in TABLE_FIELDS[groupname]:
+                    newrows[field] = oldrows[field]
+                rows[groupname].append(newrows)
+                if summaryfile:
+                    continue
+                for field,(arraygroupname,idxname) in ARRAY_FIELDS.items():
+                    if arraygroupname != groupname:
+                        continue
+                    # songs are stored in order, song i from oldrows[idxname][i]
+                    # to the next song's index or to the end of the array
+                    array = getattr(getattr(h5tocopy.root,groupname),field)
+                    start = oldrows[idxname][0] if nSongs > 0 else 0
+                    # fields sharing an index column (e.g. artist_terms and
+                    # artist_terms_freq) all give it the same values
+                    newrows[idxname] = lengths[field] + oldrows[idxname] - start
+                    lengths[field] += array.nrows - start
+                    if bigfile:
+                        bigarrays.append((field,array,start))
+                    else:
+                        arrays[field].append(array[start:])
+            nbuffered += nSongs
+            if nbuffered >= bufsize:
+                flush()
+                nbuffered = 0
+            for field,array,start in bigarrays:
+                groupname = ARRAY_FIELDS[field][0]
+                dest = getattr(getattr(h5.root,groupname),field)
+                for pos in xrange(start,array.nrows,bufsize*100):
+                    dest.append(array[pos:pos+bufsize*100])
+        finally:
+            h5tocopy.close()
+    flush()
+
+
+def create_aggregate_shard_wrapper(args):
+    """ wrapper for multiprocessing to call create_aggregate_shard """
+    create_aggregate_shard(**args)
+
+def create_aggregate_shard(h5filename=None,h5_filenames=[],summaryfile=False):
+    """
+    Create and fill one shard of an aggregate or summary file
+    (see create_aggregate_file_parallel), uncompressed
+    """
+    create_aggregate_file(h5filename,expectedrows=len(h5_filenames),complevel=0,
+                          summaryfile=summaryfile)
+    h5 = open_h5_file_append(h5filename)
+    try:
+        fill_hdf5_aggregate_file_bulk(h5,h5_filenames,summaryfile=summaryfile)
+    finally:
+        h5.close()
+
+def create_aggregate_file_parallel(h5filename,h5_filenames,summaryfile=False,nworkers=0,
+                                   nshards=None,complevel=1,force=False,tmpdir=None,
+                                   profile=None):
+    """
+    Create and fill an aggregate (or summary) file from many HDF5 files,
+    using nworkers processes (0 for one per core).
+    The list of files is split into nshards contiguous shards (4 per worker
+    by default), each filled in its own temporary aggregate file by a worker,
+    then the shards are merged in order into h5filename in a single pass
+    that shifts their indices. Songs end up in the same order as with
+    create_aggregate_file and fill_hdf5_aggregate_file.
+    Shards go in a temporary directory inside tmpdir (by default the
+    directory of h5filename) and are removed at the end.
+    complevel and profile are the ones of the final file, see
+    create_aggregate_file.
+    If force=False, refuse to overwrite an existing file
+    Raise a ValueError if it's the case.
+    """
+    if not force and os.path.exists(h5filename):
+        raise ValueError('file exists, can not create HDF5 aggregate file')
+    if nworkers < 1:
+        nworkers = multiprocessing.cpu_count()
+    if nshards is None:
+        nshards = nworkers * 4
+    nshards = max(1,min(nshards,len(h5_filenames)))
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(h5filename))
+    sharddir = tempfile.mkdtemp(prefix='shards_',dir=tmpdir)
+    try:
+        # contiguous shards, to keep the songs in order
+        files_per_shard = int(np.ceil(len(h5_filenames) * 1. / nshards))
+        params_list = []
+        for k in range(nshards):
+            params = {'h5filename':os.path.join(sharddir,'shard_%05d.h5' % k),
+                      'h5_filenames':h5_filenames[files_per_shard*k:files_per_shard*(k+1)],
+                      'summaryfile':summaryfile}
+            if len(params['h5_filenames']) > 0:
+                params_list.append(params)
+        if nworkers == 1:
+            map(create_aggregate_shard_wrapper,params_list)
+        else:
+            pool = multiprocessing.Pool(processes=nworkers)
+            try:
+                pool.map(create_aggregate_shard_wrapper,params_list)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        # merge
+        create_aggregate_file(h5filename,expectedrows=len(h5_filenames),complevel=complevel,
+                              summaryfile=summaryfile,force=force,profile=profile)
+        h5 = open_h5_file_append(h5filename)
+        try:
+            fill_hdf5_aggregate_file_bulk(h5,[p['h5filename'] for p in params_list],
+                                          summaryfile=summaryfile)
+        finally:
+            h5.close()
+    finally:
+        shutil.rmtree(sharddir)
+
+def get_storage_profile(profile=None):
+    """
+    Return the storage profile of that name (see STORAGE_PROFILES),
+    'default' if None. Raise a ValueError on an unknown name.
+    """
+    if profile is None:
+        profile = 'default'
+    if not profile in STORAGE_PROFILES:
+        raise ValueError('unknown storage profile: '+str(profile))
+    return STORAGE_PROFILES[profile]
+
+def get_storage_filters(profile=None):
+    """
+    Return the tables.Filters of a storage profile
+    """
+    profile = get_storage_profile(profile)
+    complib = profile['complib']
+    if tables.whichLibVersion(complib) is None:
+        complib = 'zlib'
+    return tables.Filters(complevel=profile['complevel'],complib=complib,
+                          shuffle=profile['shuffle'])
+
+
+def create_song_file(h5filename,title='H5 Song File',force=False,complevel=1,profile=None):
     """
     Create a new HDF5 file for a new song.
     If force=False, refuse to overwrite an existing file
@@ -375,15 +576,23 @@ def create_song_file(h5filename,title='H5 Song File',force=False,complevel=1):
     DETAIL
     - we set the compression level to 1 by default, it uses the ZLIB library
       to disable compression, set it to 0
+    - profile is a storage profile name (see STORAGE_PROFILES), it sets
+      the compression, the chunks and the dtypes of the arrays,
+      and overrides complevel
     """
     # check if file exists
     if not force:
         if os.path.exists(h5filename):
             raise ValueError('file exists, can not create HDF5 song file')
+    # filters, from the profile if any
+    if profile is None:
+        filters = tables.Filters(complevel=complevel,complib='zlib')
+    else:
+        filters = get_storage_filters(profile)
     # create the H5 file
     h5 = tables.openFile(h5filename, mode='w', title='H5 Song File')
     # set filter level
-    h5.filters = tables.Filters(complevel=complevel,complib='zlib')
+    h5.filters = filters
     # setup the groups and tables
         # group metadata
     group = h5.createGroup("/",'metadata','metadata about the song')
@@ -404,13 +613,13 @@ def create_song_file(h5filename,title='H5 Song File',force=False,complevel=1):
     r.append() # filled with default values 0 or '' (depending on type)
     table.flush()
     # create arrays
-    create_all_arrays(h5,expectedrows=3)
+    create_all_arrays(h5,expectedrows=3,profile=profile)
     # close it, done
     h5.close()
 
 
 def create_aggregate_file(h5filename,title='H5 Aggregate File',force=False,expectedrows=1000,complevel=1,
-                          summaryfile=False):
+                          summaryfile=False,profile=None):
     """
     Create a new HDF5 file for all songs.
     It will contains everything that are in regular song files.
@@ -425,6 +634,9 @@ def create_aggregate_file(h5filename,title='H5 Aggregate File',force=False,expec
       setting the chunking correctly).
     - we set the compression level to 1 by default, it uses the ZLIB library
       to disable compression, set it to 0
+    - profile is a storage profile name (see STORAGE_PROFILES), it sets
+      the compression, the chunks and the dtypes of the arrays,
+      and overrides complevel
 
     Setups the groups, each containing a table 'songs' with one row:
     - metadata
@@ -437,10 +649,15 @@ def create_aggregate_file(h5filename,title='H5 Aggregate File',force=False,expec
     # summary file? change title
     if summaryfile:
         title = 'H5 Summary File'
+    # filters, from the profile if any
+    if profile is None:
+        filters = tables.Filters(complevel=complevel,complib='zlib')
+    else:
+        filters = get_storage_filters(profile)
     # create the H5 file
     h5 = tables.openFile(h5filename, mode='w', title='H5 Song File')
     # set filter level
-    h5.filters = tables.Filters(complevel=complevel,complib='zlib')
+    h5.filters = filters
     # setup the groups and tables
         # group metadata
     group = h5.createGroup("/",'metadata','metadata about the song')
@@ -456,65 +673,79 @@ def create_aggregate_file(h5filename,title='H5 Aggregate File',force=False,expec
                            expectedrows=expectedrows)
     # create arrays
     if not summaryfile:
-        create_all_arrays(h5,expectedrows=expectedrows)
+        create_all_arrays(h5,expectedrows=expectedrows,profile=profile)
     # close it, done
     h5.close()
 
 
-def create_all_arrays(h5,expectedrows=1000):
+def create_all_arrays(h5,expectedrows=1000,profile=None):
     """
     Utility functions used by both create_song_file and create_aggregate_files,
     creates all the EArrays (empty).
     INPUT
        h5   - hdf5 file, open with write or append permissions
               metadata and analysis groups already exist!
+       profile - storage profile name (see STORAGE_PROFILES), sets the
+                 chunks of the arrays and the dtype of the segments arrays
     """
+    profile = get_storage_profile(profile)
+    if profile['float32_segments']:
+        segatom = tables.Float32Atom(shape=())
+    else:
+        segatom = tables.Float64Atom(shape=())
+    def chunks(shape,nrows):
+        # at most the expected number of rows, e.g. for single song files
+        if profile['chunkrows'] is None:
+            return None
+        return (max(1,min(profile['chunkrows'],nrows)),) + shape[1:]
     # group metadata arrays
     group = h5.root.metadata
-    h5.createEArray(where=group,name='similar_artists',atom=tables.StringAtom(20,shape=()),shape=(0,),title=ARRAY_DESC_SIMILAR_ARTISTS)
+    h5.createEArray(where=group,name='similar_artists',atom=tables.StringAtom(20,shape=()),shape=(0,),title=ARRAY_DESC_SIMILAR_ARTISTS,
+                    chunkshape=chunks((0,),expectedrows*40))
     h5.createEArray(group,'artist_terms',tables.StringAtom(256,shape=()),(0,),ARRAY_DESC_ARTIST_TERMS,
-                    expectedrows=expectedrows*40)
+                    expectedrows=expectedrows*40,chunkshape=chunks((0,),expectedrows*40))
     h5.createEArray(group,'artist_terms_freq',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_ARTIST_TERMS_FREQ,
-                    expectedrows=expectedrows*40)
+                    expectedrows=expectedrows*40,chunkshape=chunks((0,),expectedrows*40))
     h5.createEArray(group,'artist_terms_weight',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_ARTIST_TERMS_WEIGHT,
-                    expectedrows=expectedrows*40)
+                    expectedrows=expectedrows*40,chunkshape=chunks((0,),expectedrows*40))
     # group analysis arrays
     group = h5.root.analysis
-    h5.createEArray(where=group,name='segments_start',atom=tables.Float64Atom(shape=()),shape=(0,),title=ARRAY_DESC_SEGMENTS_START)
-    h5.createEArray(group,'segments_confidence',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SEGMENTS_CONFIDENCE,
-                    expectedrows=expectedrows*300)
-    h5.createEArray(group,'segments_pitches',tables.Float64Atom(shape=()),(0,12),ARRAY_DESC_SEGMENTS_PITCHES,
-                    expectedrows=expectedrows*300)
-    h5.createEArray(group,'segments_timbre',tables.Float64Atom(shape=()),(0,12),ARRAY_DESC_SEGMENTS_TIMBRE,
-                    expectedrows=expectedrows*300)
-    h5.createEArray(group,'segments_loudness_max',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_MAX,
-                    expectedrows=expectedrows*300)
-    h5.createEArray(group,'segments_loudness_max_time',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_MAX_TIME,
-                    expectedrows=expectedrows*300)
-    h5.createEArray(group,'segments_loudness_start',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_START,
-                    expectedrows=expectedrows*300)
+    h5.createEArray(where=group,name='segments_start',atom=segatom,shape=(0,),title=ARRAY_DESC_SEGMENTS_START,
+                    chunkshape=chunks((0,),expectedrows*300))
+    h5.createEArray(group,'segments_confidence',segatom,(0,),ARRAY_DESC_SEGMENTS_CONFIDENCE,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
+    h5.createEArray(group,'segments_pitches',segatom,(0,12),ARRAY_DESC_SEGMENTS_PITCHES,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,12),expectedrows*300))
+    h5.createEArray(group,'segments_timbre',segatom,(0,12),ARRAY_DESC_SEGMENTS_TIMBRE,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,12),expectedrows*300))
+    h5.createEArray(group,'segments_loudness_max',segatom,(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_MAX,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
+    h5.createEArray(group,'segments_loudness_max_time',segatom,(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_MAX_TIME,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
+    h5.createEArray(group,'segments_loudness_start',segatom,(0,),ARRAY_DESC_SEGMENTS_LOUDNESS_START,
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'sections_start',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SECTIONS_START,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'sections_confidence',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_SECTIONS_CONFIDENCE,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'beats_start',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_BEATS_START,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'beats_confidence',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_BEATS_CONFIDENCE,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'bars_start',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_BARS_START,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'bars_confidence',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_BARS_CONFIDENCE,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'tatums_start',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_TATUMS_START,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     h5.createEArray(group,'tatums_confidence',tables.Float64Atom(shape=()),(0,),ARRAY_DESC_TATUMS_CONFIDENCE,
-                    expectedrows=expectedrows*300)
+                    expectedrows=expectedrows*300,chunkshape=chunks((0,),expectedrows*300))
     # group musicbrainz arrays
     group = h5.root.musicbrainz
     h5.createEArray(where=group,name='artist_mbtags',atom=tables.StringAtom(256,shape=()),shape=(0,),title=ARRAY_DESC_ARTIST_MBTAGS,
-                    expectedrows=expectedrows*5)
+                    expectedrows=expectedrows*5,chunkshape=chunks((0,),expectedrows*5))
     h5.createEArray(group,'artist_mbtags_count',tables.IntAtom(shape=()),(0,),ARRAY_DESC_ARTIST_MBTAGS_COUNT,
-                    expectedrows=expectedrows*5)
+                    expectedrows=expectedrows*5,chunkshape=chunks((0,),expectedrows*5))
 
 
 def open_h5_file_read(h5filename):
@@ -0,0 +1,228 @@
+"""
+This code queries a summary file (see create_summary_file.py), or an
+aggregate file, for the songs matching conditions on their fields,
+e.g. 'year >= 2000', 'tempo > 120', '(key == 5) & (mode == 1)'.
+
+Each condition is evaluated in-kernel by PyTables (table.where / numexpr)
+on the table holding its fields, without reading rows into Python, and
+uses the column indexes if there are any (see create_indexes).
+Row i of every table is song i, so the songs matching all conditions are
+the intersection of the rows matching each of them.
+
+Over the 1M songs of the full summary file, a range query on the
+analysis or musicbrainz tables takes well under a second if the file was
+built with the fast-read storage profile (create_summary_file.py
+--profile fast-read), a few seconds with the default zlib one.
+Conditions on the wide metadata table need its columns indexed (-index)
+to be as fast, unless other conditions already kept few songs.
+
+This is part of the Million Song Dataset project from
+LabROSA (Columbia University) and The Echo Nest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import sys
+import time
+import datetime
+import numpy as np
+import numexpr
+import tables
+# project code
+import hdf5_getters
+
+
+# fields that are worth indexing for range queries
+INDEXED_FIELDS = ('year','tempo','loudness','key','mode','duration',
+                  'song_hotttnesss','artist_hotttnesss','artist_familiarity')
+
+
+def field_table(field):
+    """
+    Return the name of the table (group) holding a scalar field,
+    raise a ValueError if it is not one
+    """
+    for tablename,tablefields in hdf5_getters.TABLE_FIELDS.items():
+        if field in tablefields:
+            return tablename
+    raise ValueError('unknown scalar field: '+field)
+
+
+def condition_table(condition,condvars=None):
+    """
+    Return the name of the table a condition is about.
+    All the fields in a condition must be in the same table,
+    raise a ValueError otherwise.
+    """
+    if condvars is None:
+        condvars = {}
+    tablenames = set()
+    for name in re.findall(r'[A-Za-z_][A-Za-z0-9_]*',condition):
+        if name in condvars:
+            continue
+        for tablename,tablefields in hdf5_getters.TABLE_FIELDS.items():
+            if name in tablefields:
+                tablenames.add(tablename)
+    if len(tablenames) != 1:
+        raise ValueError('condition must be on fields of one table '
+                         '(metadata, analysis or musicbrainz): '+condition)
+    return tablenames.pop()
+
+
+def query_songidxs(h5,conditions,condvars=None):
+    """
+    Return the sorted indices of the songs matching all the conditions
+    (a string or a list of strings) in an open summary or aggregate file.
+    condvars maps names used in the conditions to values,
+    e.g. query_songidxs(h5,'tempo > mintempo',{'mintempo':120})
+    Conditions on the same table are evaluated together, tables with the
+    smallest rows first. A table is searched with table.where (and its
+    indexes), unless the songs still matching are few enough that
+    reading their rows only is cheaper, then the condition is evaluated
+    on those rows with numexpr.
+    """
+    if isinstance(conditions,basestring):
+        conditions = [conditions]
+    if condvars is None:
+        condvars = {}
+    # conditions per table
+    bytable = {}
+    for condition in conditions:
+        tablename = condition_table(condition,condvars)
+        bytable.setdefault(tablename,[]).append('(' + condition + ')')
+    tablenames = sorted(bytable,key=lambda t: getattr(h5.root,t).songs.rowsize)
+    songidxs = None
+    for tablename in tablenames:
+        table = getattr(h5.root,tablename).songs
+        condition = ' & '.join(bytable[tablename])
+        if songidxs is None or len(songidxs) * table.chunkshape[0] >= table.nrows:
+            coords = table.getWhereList(condition,condvars=condvars,sort=True)
+            if songidxs is None:
+                songidxs = coords
+            else:
+                songidxs = np.intersect1d(songidxs,coords)
+        else:
+            rows = table.readCoordinates(songidxs)
+            names = dict((n,rows[n]) for n in rows.dtype.names)
+            names.update(condvars)
+            songidxs = songidxs[numexpr.evaluate(condition,local_dict=names)]
+        if len(songidxs) == 0:
+            break
+    if songidxs is None:
+        songidxs = np.arange(hdf5_getters.get_num_songs(h5))
+    return np.asarray(songidxs,dtype=np.int64)
+
+
+def query(h5,conditions,fields=('track_id',),condvars=None):
+    """
+    Get the songs matching all the conditions in an open summary or aggregate
+    file (see query_songidxs), as a dictionary of arrays: 'songidx' for their
+    indices in the file, 'track_id' and the requested scalar fields.
+    Only the rows of the matching songs are read, once per table.
+    """
+    songidxs = query_songidxs(h5,conditions,condvars=condvars)
+    res = {'songidx':songidxs}
+    fields = ['track_id'] + [f for f in fields if f != 'track_id']
+    bytable = {}
+    for field in fields:
+        bytable.setdefault(field_table(field),[]).append(field)
+    for tablename,tablefields in bytable.items():
+        table = getattr(h5.root,tablename).songs
+        if len(songidxs) == 0:
+            rows = table.read(0,0)
+        else:
+            rows = table.readCoordinates(songidxs)
+        for field in tablefields:
+            res[field] = rows[field]
+    return res
+
+
+def create_indexes(h5,fields=INDEXED_FIELDS):
+    """
+    Create column indexes on scalar fields of a summary or aggregate file
+    open in append mode, to speed up the queries on them.
+    Fields already indexed are skipped.
+    """
+    for field in fields:
+        column = getattr(getattr(h5.root,field_table(field)).songs.cols,field)
+        if not column.is_indexed:
+            column.createIndex()
+
+
+def die_with_usage():
+    """ HELP MENU """
+    print 'summary_query.py'
+    print 'Query a summary file (or aggregate file) for the songs matching'
+    print 'conditions on their fields, evaluated in-kernel by PyTables.'
+    print ' '
+    print 'usage:'
+    print '   python summary_query.py [FLAGS] <SUMMARY.h5> <CONDITION> [<CONDITION> ...]'
+    print 'PARAMS'
+    print '   SUMMARY.h5  - summary file, see create_summary_file.py'
+    print '   CONDITION   - e.g. "year >= 2000", "(tempo > 120) & (tempo < 130)",'
+    print '                 fields of one condition must be in the same table'
+    print 'FLAGS'
+    print '   -fields F1,F2  - fields to print after the track_id'
+    print '   -index         - first create the indexes of the fields worth indexing:'
+    print '                    '+','.join(INDEXED_FIELDS)
+    print ' '
+    print 'example:'
+    print '   python summary_query.py -fields year,tempo msd_summary_file.h5 "year >= 2000" "tempo > 150"'
+    sys.exit(0)
+
+if __name__ == '__main__':
+
+    # help menu
+    if len(sys.argv) < 3:
+        die_with_usage()
+
+    # flags
+    fields = []
+    index = False
+    while True:
+        if sys.argv[1] == '-fields':
+            fields = sys.argv[2].split(',')
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-index':
+            index = True
+        else:
+            break
+        sys.argv.pop(1)
+
+    # params
+    summaryfile = sys.argv[1]
+    conditions = sys.argv[2:]
+    if not os.path.isfile(summaryfile):
+        print 'ERROR: file',summaryfile,'does not exist.'
+        sys.exit(0)
+
+    # indexes
+    if index:
+        t1 = time.time()
+        h5 = tables.openFile(summaryfile, mode='a')
+        create_indexes(h5)
+        h5.close()
+        print 'indexes created in',str(datetime.timedelta(seconds=time.time()-t1))
+
+    # query
+    t1 = time.time()
+    h5 = hdf5_getters.open_h5_file_read(summaryfile)
+    res = query(h5,conditions,fields=fields)
+    h5.close()
+    stimelength = str(datetime.timedelta(seconds=time.time()-t1))
+    for k in range(len(res['songidx'])):
+        print '\t'.join([res['track_id'][k]] + [str(res[f][k]) for f in fields])
+    print len(res['songidx']),'songs found in',stimelength
@@ -39,45 +39,249 @@ except ImportError:
     raise
 
 
-def get_btchromas(h5):
+# beat-aligned features get_btfeats can compute
+BTFEATS = ('chromas', 'chromas_loudness', 'timbre', 'loudnessmax')
+# time grids get_btfeats_pyramid can align on, finest first
+PYRAMID_LEVELS = ('tatums', 'beats', 'bars', 'sections')
+
+
+def get_btfeats_fields(featnames):
     """
-    Get beat-aligned chroma from a song file of the Million Song Dataset
+    Check the names of beat-aligned features and return the fields
+    (getter names without 'get_') needed to compute them
+    """
+    for featname in featnames:
+        if not featname in BTFEATS:
+            raise ValueError('unknown beat-aligned feature: ' + featname)
+    fields = ['segments_start', 'beats_start', 'duration']
+    if 'chromas' in featnames or 'chromas_loudness' in featnames:
+        fields.append('segments_pitches')
+    if 'timbre' in featnames:
+        fields.append('segments_timbre')
+    if 'chromas_loudness' in featnames or 'loudnessmax' in featnames:
+        fields.append('segments_loudness_max')
+    return fields
+
+
+def stack_segment_feats(featnames, song):
+    """
+    Segment features needed for featnames, from a dictionary of fields
+    (see get_btfeats_fields), as a list of matrices to stack,
+    one column per segment
+    """
+    feats = []
+    for featname in featnames:
+        if featname == 'chromas':
+            feats.append(song['segments_pitches'].T)
+        elif featname == 'chromas_loudness':
+            # add back loudness
+            feats.append(song['segments_pitches'].T
+                         * idB(song['segments_loudness_max']))
+        elif featname == 'timbre':
+            feats.append(song['segments_timbre'].T)
+        elif featname == 'loudnessmax':
+            # reverse dB
+            loudnessmax = idB(song['segments_loudness_max'])
+            feats.append(loudnessmax.reshape(1, loudnessmax.shape[0]))
+    return feats
+
+
+def split_btfeats(featnames, feats, btstacked):
+    """
+    Split the beat alignment of the stacked segment features feats
+    (see stack_segment_feats), and finish them: chromas are renormalized,
+    loudness set back in dB.
+    Return a dictionary featname -> features, one beat per column
+    """
+    btfeats = {}
+    row = 0
+    for featname, feat in zip(featnames, feats):
+        btfeat = btstacked[row:row + feat.shape[0]]
+        row += feat.shape[0]
+        if featname == 'chromas':
+            # Renormalize. Each column max is 1.
+            maxs = btfeat.max(axis=0)
+            maxs[np.where(maxs == 0)] = 1.
+            btfeat = (btfeat / maxs)
+        elif featname == 'loudnessmax':
+            # set it back to dB
+            btfeat = dB(btfeat + 1e-10)
+        btfeats[featname] = btfeat
+    # done (no renormalization of the other features)
+    return btfeats
+
+
+def get_btfeats(h5, featnames=BTFEATS, songidx=0, compression=1):
+    """
+    Get several beat-aligned features of a song of the Million Song Dataset
+    at once: the segment and beat arrays are read once, in a single pass,
+    the time warp is computed once, and all features are aligned together.
     INPUT:
        h5          - filename or open h5 file
+       featnames   - features to compute, from BTFEATS:
+                     'chromas' (see get_btchromas), 'chromas_loudness'
+                     (see get_btchromas_loudness), 'timbre' (see
+                     get_bttimbre), 'loudnessmax' (see get_btloudnessmax)
+       songidx     - song in the file, for aggregate files
+       compression - align on every compression-th beat only
     RETURN:
-       btchromas   - beat-aligned chromas, one beat per column
+       btfeats     - dictionary featname -> features, one beat per column
                      or None if something went wrong (e.g. no beats)
     """
-    # if string, open and get chromas, if h5, get chromas
+    # read only the segment arrays we need
+    fields = get_btfeats_fields(featnames)
+    # if string, open and get arrays, if h5, get arrays
     if type(h5).__name__ == 'str':
         h5 = GETTERS.open_h5_file_read(h5)
-        chromas = GETTERS.get_segments_pitches(h5)
-        segstarts = GETTERS.get_segments_start(h5)
-        btstarts = GETTERS.get_beats_start(h5)
-        duration = GETTERS.get_duration(h5)
+        song = GETTERS.read_fields(h5, fields, songidx)
         h5.close()
     else:
-        chromas = GETTERS.get_segments_pitches(h5)
-        segstarts = GETTERS.get_segments_start(h5)
-        btstarts = GETTERS.get_beats_start(h5)
-        duration = GETTERS.get_duration(h5)
+        song = GETTERS.read_fields(h5, fields, songidx)
+    btfeats = dict((featname, None) for featname in featnames)
+    if len(featnames) == 0:
+        return btfeats
     # get the series of starts for segments and beats
-    # NOTE: MAYBE USELESS?
     # result for track: 'TR0002Q11C3FA8332D'
     #    segstarts.shape = (708,)
     #    btstarts.shape = (304,)
-    segstarts = np.array(segstarts).flatten()
-    btstarts = np.array(btstarts).flatten()
+    segstarts = np.array(song['segments_start']).flatten()
+    btstarts = np.array(song['beats_start']).flatten()[::compression]
     # aligned features
-    btchroma = align_feats(chromas.T, segstarts, btstarts, duration)
-    if btchroma is None:
-        return None
-    # Renormalize. Each column max is 1.
-    maxs = btchroma.max(axis=0)
-    maxs[np.where(maxs == 0)] = 1.
-    btchroma = (btchroma / maxs)
-    # done
-    return btchroma
+    feats = stack_segment_feats(featnames, song)
+    btstacked = align_feats(np.concatenate(feats), segstarts, btstarts,
+                            song['duration'])
+    if btstacked is None:
+        return btfeats
+    return split_btfeats(featnames, feats, btstacked)
+
+
+def get_btfeats_batch(h5, featnames=BTFEATS, songidxs=None, compression=1):
+    """
+    Get beat-aligned features of many songs of an aggregate file at once,
+    see get_btfeats. Each array is read with one bulk read for all songs
+    and all songs are aligned together (see align_feats_batch).
+    INPUT:
+       h5          - filename or open h5 file
+       featnames   - features to compute, from BTFEATS
+       songidxs    - a slice or an array of song indices, all by default
+       compression - align on every compression-th beat of each song only
+    RETURN:
+       btfeats     - dictionary featname -> features, one beat per column,
+                     the songs concatenated
+       offsets     - song i is btfeats[featname][:, offsets[i]:offsets[i+1]],
+                     empty where get_btfeats would return None
+    """
+    if len(featnames) == 0:
+        raise ValueError('no beat-aligned feature requested')
+    fields = get_btfeats_fields(featnames)
+    if type(h5).__name__ == 'str':
+        h5 = GETTERS.open_h5_file_read(h5)
+        songs, segoffsets, btoffsets = read_btfeats_batch(h5, fields, songidxs)
+        h5.close()
+    else:
+        songs, segoffsets, btoffsets = read_btfeats_batch(h5, fields, songidxs)
+    if compression > 1:
+        songs['beats_start'], btoffsets = compress_beats(
+            songs['beats_start'], btoffsets, compression)
+    feats = stack_segment_feats(featnames, songs)
+    btstacked, offsets = align_feats_batch(
+        np.concatenate(feats), songs['segments_start'], segoffsets,
+        songs['beats_start'], btoffsets, songs['duration'])
+    return split_btfeats(featnames, feats, btstacked), offsets
+
+
+def compress_beats(btstarts, btoffsets, compression):
+    """
+    Keep every compression-th beat of each song, the first one included,
+    of beats of many songs concatenated (song i owns
+    btstarts[btoffsets[i]:btoffsets[i+1]]).
+    Return the beats kept and their offsets.
+    """
+    nbeats = np.diff(btoffsets)
+    songs = np.repeat(np.arange(nbeats.shape[0]), nbeats)
+    keep = (np.arange(btstarts.shape[0]) - btoffsets[songs]) % compression == 0
+    offsets = np.zeros(btoffsets.shape[0], dtype=btoffsets.dtype)
+    np.cumsum((nbeats + compression - 1) // compression, out=offsets[1:])
+    return btstarts[keep], offsets
+
+
+def read_btfeats_batch(h5, fields, songidxs=None):
+    """
+    Read fields of many songs of an open aggregate file, see
+    get_btfeats_batch. Return a dictionary of the fields, arrays of all
+    songs concatenated, and the segment and beat offsets.
+    """
+    songs = {}
+    segoffsets = None
+    btoffsets = None
+    for field in fields:
+        if field == 'duration':
+            songs[field] = GETTERS.read_scalar_batch(h5, field, songidxs)
+            continue
+        songs[field], offsets = GETTERS.read_array_batch(h5, field, songidxs)
+        if field == 'beats_start':
+            btoffsets = offsets
+        elif segoffsets is None:
+            segoffsets = offsets
+        elif not (offsets == segoffsets).all():
+            raise ValueError('segment arrays of different lengths: ' + field)
+    return songs, segoffsets, btoffsets
+
+
+def get_btfeats_pyramid(h5, featnames=BTFEATS, levels=PYRAMID_LEVELS,
+                        songidx=0):
+    """
+    Get beat-aligned features of a song (see get_btfeats) aligned on
+    several time grids at once, e.g. tatums, beats, bars and sections:
+    the arrays are read once and all grids are aligned in a single sweep
+    over the segments (see align_feats_pyramid).
+    INPUT:
+       h5          - filename or open h5 file
+       featnames   - features to compute, from BTFEATS
+       levels      - time grids, from PYRAMID_LEVELS
+       songidx     - song in the file, for aggregate files
+    RETURN:
+       pyramid     - dictionary level -> featname -> features, one
+                     column per tatum, beat, bar or section
+                     or None if something went wrong (e.g. no bars)
+    """
+    for level in levels:
+        if not level in PYRAMID_LEVELS:
+            raise ValueError('unknown time grid: ' + level)
+    fields = get_btfeats_fields(featnames)
+    fields.extend([level + '_start' for level in levels
+                   if level != 'beats'])
+    if type(h5).__name__ == 'str':
+        h5 = GETTERS.open_h5_file_read(h5)
+        song = GETTERS.read_fields(h5, fields, songidx)
+        h5.close()
+    else:
+        song = GETTERS.read_fields(h5, fields, songidx)
+    pyramid = dict((level, dict((featname, None) for featname in featnames))
+                   for level in levels)
+    if len(featnames) == 0:
+        return pyramid
+    segstarts = np.array(song['segments_start']).flatten()
+    grids = [np.array(song[level + '_start']).flatten() for level in levels]
+    feats = stack_segment_feats(featnames, song)
+    stacked = align_feats_pyramid(np.concatenate(feats), segstarts, grids,
+                                  song['duration'])
+    for level, levelstacked in zip(levels, stacked):
+        if levelstacked is not None:
+            pyramid[level] = split_btfeats(featnames, feats, levelstacked)
+    return pyramid
+
+
+def get_btchromas(h5):
+    """
+    Get beat-aligned chroma from a song file of the Million Song Dataset
+    INPUT:
+       h5          - filename or open h5 file
+    RETURN:
+       btchromas   - beat-aligned chromas, one beat per column
+                     or None if something went wrong (e.g. no beats)
+    """
+    return get_btfeats(h5, ('chromas',))['chromas']
 
 
 def get_btloudnessmax(h5):
@@ -89,38 +293,7 @@ def get_btloudnessmax(h5):
        btloudnessmax  - beat-aligned loudness max, one beat per column
                         or None if something went wrong (e.g. no beats)
     """
-    # if string, open and get max loudness, if h5, get max loudness
-    if type(h5).__name__ == 'str':
-        h5 = GETTERS.open_h5_file_read(h5)
-        loudnessmax = GETTERS.get_segments_loudness_max(h5)
-        segstarts = GETTERS.get_segments_start(h5)
-        btstarts = GETTERS.get_beats_start(h5)
-        duration = GETTERS.get_duration(h5)
-        h5.close()
-    else:
-        loudnessmax = GETTERS.get_segments_loudness_max(h5)
-        segstarts = GETTERS.get_segments_start(h5)
-        btstarts = GETTERS.get_beats_start(h5)
-        duration = GETTERS.get_duration(h5)
-    # get the series of starts for segments and beats
-    # NOTE: MAYBE USELESS?
-    # result for track: 'TR0002Q11C3FA8332D'
-    #    segstarts.shape = (708,)
-    #    btstarts.shape = (304,)
-    segstarts = np.array(segstarts).flatten()
-    btstarts = np.array(btstarts).flatten()
-    # reverse dB
-    loudnessmax = idB(loudnessmax)
-    # aligned features
-    btloudnessmax = align_feats(loudnessmax.reshape(1,
-                                                    loudnessmax.shape[0]),
-                                segstarts, btstarts, duration)
-    if btloudnessmax is None:
-        return None
-    # set it back to dB
-    btloudnessmax = dB(btloudnessmax + 1e-10)
-    # done (no renormalization)
-    return btloudnessmax
+    return get_btfeats(h5, ('loudnessmax',))['loudnessmax']
 
 
 def align_feats(feats, segstarts, btstarts, duration):
@@ -148,10 +321,12 @@ def align_feats(feats, segstarts, btstarts, duration):
     # FEAT PER BEAT
     # Move segment feature onto a regular grid
     # result for track: 'TR0002Q11C3FA8332D'
-    #    warpmat.shape = (304, 708)
+    #    about 304 + 708 weights instead of a (304, 708) warp matrix
     #    btchroma.shape = (304, 12)
-    warpmat = get_time_warp_matrix(segstarts, btstarts, duration)
-    featchroma = np.dot(warpmat, feats.T).T
+    btidx, segidx, weights = get_time_warp_weights(segstarts, btstarts,
+                                                   duration)
+    featchroma = apply_time_warp(feats, btidx, segidx, weights,
+                                 btstarts.shape[0])
     if featchroma.shape[1] == 0: # sanity check
         return None
 
@@ -159,59 +334,232 @@ def align_feats(feats, segstarts, btstarts, duration):
     return featchroma
 
 
+def align_feats_batch(feats, segstarts, segoffsets, btstarts, btoffsets,
+                      durations):
+    """
+    Same as align_feats for many songs at once, e.g. the songs of an
+    aggregate file: all songs are aligned together in a few vectorized
+    operations, with no loop over songs.
+    INPUT
+       feats      - matrix of features, one column per segment,
+                    songs concatenated
+       segstarts  - segments starts in seconds, songs concatenated
+       segoffsets - len(songs)+1 offsets, the segments of song i are
+                    segstarts[segoffsets[i]:segoffsets[i+1]]
+       btstarts   - beat starts in seconds, songs concatenated
+       btoffsets  - len(songs)+1 offsets of the beats of each song
+       durations  - overall track durations in seconds, one per song
+    RETURN
+       btfeats    - features, one column per beat, songs concatenated
+       offsets    - len(songs)+1 offsets, song i is
+                    btfeats[:, offsets[i]:offsets[i+1]], empty where
+                    align_feats would return None (no segments or beats)
+    """
+    segoffsets = np.asarray(segoffsets, dtype=np.int64)
+    btoffsets = np.asarray(btoffsets, dtype=np.int64)
+    btidx, segidx, weights = get_time_warp_weights_batch(
+        segstarts, segoffsets, btstarts, btoffsets, durations)
+    btfeats = apply_time_warp(feats, btidx, segidx, weights,
+                              btstarts.shape[0])
+    # drop the beats of songs without segments
+    nbeats = np.diff(btoffsets)
+    nbeats[np.diff(segoffsets) == 0] = 0
+    offsets = np.zeros(nbeats.shape[0] + 1, dtype=np.int64)
+    np.cumsum(nbeats, out=offsets[1:])
+    if offsets[-1] < btstarts.shape[0]:
+        btfeats = btfeats[:, np.repeat(nbeats > 0, np.diff(btoffsets))]
+    return btfeats, offsets
+
+
+def align_feats_pyramid(feats, segstarts, grids, duration):
+    """
+    Same as align_feats on several time grids of a song at once, e.g.
+    tatum, beat, bar and section starts. The grids are aligned together,
+    as the songs of align_feats_batch with the same segments, so the
+    segments are searched and their features gathered in a single sweep.
+    Each grid is aligned from the segments, not from a finer grid: with
+    the weights of align_feats, the average of the beats of a bar is not
+    the bar's features.
+    INPUT
+       feats      - matrix of features, one column per segment
+       segstarts  - segments starts in seconds (flatten ndarray)
+       grids      - list of time grids, starts in seconds (flatten ndarrays)
+       duration   - overall track duration in seconds
+    RETURN
+       gridfeats  - list of features, one column per grid element,
+                    None where align_feats would return None
+    """
+    # sanity check
+    if feats.shape[0] == 0 or feats.shape[1] == 0 or segstarts.shape[0] == 0:
+        return [None] * len(grids)
+    # each grid is a song with the same segments
+    nsegs = segstarts.shape[0]
+    ngrids = len(grids)
+    segoffsets = np.arange(ngrids + 1, dtype=np.int64) * nsegs
+    gridoffsets = np.zeros(ngrids + 1, dtype=np.int64)
+    np.cumsum([grid.shape[0] for grid in grids], out=gridoffsets[1:])
+    btidx, segidx, weights = get_time_warp_weights_batch(
+        np.tile(segstarts, ngrids), segoffsets,
+        np.concatenate(grids), gridoffsets, [duration] * ngrids)
+    # back to the segments of the song
+    segidx %= nsegs
+    allfeats = apply_time_warp(feats, btidx, segidx, weights, gridoffsets[-1])
+    gridfeats = []
+    for k in xrange(ngrids):
+        if gridoffsets[k + 1] == gridoffsets[k]:
+            gridfeats.append(None)
+        else:
+            gridfeats.append(allfeats[:, gridoffsets[k]:gridoffsets[k + 1]])
+    return gridfeats
+
+
+def get_time_warp_weights(segstart, btstart, duration):
+    """
+    Nonzero elements of the time warp matrix (see get_time_warp_matrix),
+    i.e. the proportion of each segment inside each beat, normalized so
+    the weights of a beat sum to one.
+    Segment starts must be sorted. Segments are found with searchsorted,
+    a beat overlaps a few segments, so this is O(#beats + #segs)
+    instead of O(#beats x #segs).
+    RETURN
+       btidx    - beat of each weight, sorted (beats starting after
+                  the last segment start have none)
+       segidx   - segment of each weight
+       weights  - the weights
+    """
+    return get_time_warp_weights_batch(segstart, [0, len(segstart)],
+                                       btstart, [0, len(btstart)],
+                                       [duration])
+
+
+def get_time_warp_weights_batch(segstarts, segoffsets, btstarts, btoffsets,
+                                durations):
+    """
+    Same as get_time_warp_weights for many songs, segments and beats of
+    all songs concatenated (see align_feats_batch for the parameters).
+    Beat and segment indices of the weights are in the concatenations.
+    """
+    segoffsets = np.asarray(segoffsets, dtype=np.int64)
+    btoffsets = np.asarray(btoffsets, dtype=np.int64)
+    durations = np.asarray(durations).flatten()
+    nsegs = np.diff(segoffsets)
+    btsongs = np.repeat(np.arange(nsegs.shape[0]), np.diff(btoffsets))
+    # length of beats and segments in seconds, the last ones of a song
+    # end with the song
+    seglen = _next_starts(segstarts, segoffsets, durations) - segstarts
+    btlen = _next_starts(btstarts, btoffsets, durations) - btstarts
+    # first segment that starts after beat starts - 1 (in the song),
+    # stop each song at its first beat with no segment start after it
+    start_idx = _searchsorted_songs(segstarts, segoffsets, btstarts, btsongs)
+    nostart = np.cumsum(start_idx == nsegs[btsongs])
+    nostart -= np.concatenate(([0], nostart))[btoffsets[:-1]][btsongs]
+    beats = np.nonzero(nostart == 0)[0]
+    songs = btsongs[beats]
+    segoff = segoffsets[songs]
+    start = btstarts[beats]
+    end = start + btlen[beats]
+    start_idx = start_idx[beats] - 1
+    # first segment that starts after beat ends, start_idx if none
+    end_idx = _searchsorted_songs(segstarts, segoffsets, end, songs)
+    noend = end_idx == nsegs[songs]
+    end_idx[noend] = start_idx[noend]
+    # if the beat started after the segment, keep the proportion
+    # of the segment that is inside the beat
+    firstseg = segoff + start_idx % nsegs[songs]
+    first = 1. - ((start - segstarts[firstseg]) / seglen[firstseg])
+    # if the segment ended after the beat ended, keep the proportion
+    # of the segment that is inside the beat
+    haslast = end_idx - 1 > start_idx
+    lastseg = segoff[haslast] + end_idx[haslast] - 1
+    last = (end[haslast] - segstarts[lastseg]) / seglen[lastseg]
+    # segments in between count fully, except for a beat that starts
+    # on the first segment (start_idx = -1): as in the original loop,
+    # its start weight goes to the last segment and nothing is in between
+    nfull = np.maximum(end_idx - start_idx - 2, 0)
+    nfull[start_idx < 0] = 0
+    fullbt = np.repeat(beats, nfull)
+    fullseg = (np.arange(fullbt.shape[0])
+               - np.repeat(np.cumsum(nfull) - nfull, nfull)
+               + np.repeat(segoff + start_idx + 1, nfull))
+    # the last weight replaces the first one when on the same segment
+    hasfirst = ~haslast | (segoff + end_idx - 1 != firstseg)
+    btidx = np.concatenate((beats[hasfirst], fullbt, beats[haslast]))
+    segidx = np.concatenate((firstseg[hasfirst], fullseg, lastseg))
+    weights = np.concatenate((first[hasfirst], np.ones(fullbt.shape[0]),
+                              last))
+    order = np.argsort(btidx, kind='mergesort')
+    btidx = btidx[order]
+    segidx = segidx[order]
+    weights = weights[order]
+    # normalize so the 'energy' for one beat is one
+    weights /= np.bincount(btidx, weights=weights,
+                           minlength=btstarts.shape[0])[btidx]
+    return btidx, segidx, weights
+
+
+def _next_starts(starts, offsets, durations):
+    """
+    Start of the next element of each song for concatenated starts,
+    the song duration for the last one
+    """
+    nexts = np.empty(starts.shape[0])
+    nexts[:-1] = starts[1:]
+    notempty = offsets[1:] > offsets[:-1]
+    nexts[offsets[1:][notempty] - 1] = durations[notempty]
+    return nexts
+
+
+def _searchsorted_songs(segstarts, segoffsets, values, songs):
+    """
+    Index of the first segment starting at or after each value, in the
+    segments of the song of the value (np.searchsorted, side='left',
+    song by song). The segment starts of each song must be sorted.
+    """
+    if segoffsets.shape[0] == 2:
+        return np.searchsorted(segstarts, values, side='left')
+    # complex numbers sort by real then imaginary part: with the song as
+    # real part and the time as imaginary part, the segments of all songs
+    # are sorted and one searchsorted finds all the indices
+    segkeys = np.empty(segstarts.shape[0], dtype=np.complex128)
+    segkeys.real = np.repeat(np.arange(segoffsets.shape[0] - 1),
+                             np.diff(segoffsets))
+    segkeys.imag = segstarts
+    keys = np.empty(values.shape[0], dtype=np.complex128)
+    keys.real = songs
+    keys.imag = values
+    return np.searchsorted(segkeys, keys, side='left') - segoffsets[songs]
+
+
+def apply_time_warp(feats, btidx, segidx, weights, nbeats):
+    """
+    Multiply features, one column per segment, by the time warp matrix
+    given by its nonzero weights (see get_time_warp_weights), without
+    building the matrix.
+    RETURN
+       btfeats    - features, one column per beat (nbeats columns)
+    """
+    btfeats = np.empty((feats.shape[0], nbeats))
+    # sum the weighted segments of each beat, one dimension at a time
+    for k in xrange(feats.shape[0]):
+        btfeats[k] = np.bincount(btidx, weights=feats[k, segidx] * weights,
+                                 minlength=nbeats)
+    return btfeats
+
+
 def get_time_warp_matrix(segstart, btstart, duration):
     """
     Used by create_beat_synchro_chromagram
     Returns a matrix (#beats,#segs)
     #segs should be larger than #beats, i.e. many events or segs
     happen in one beat.
+    align_feats does not build it anymore, see get_time_warp_weights.
     THIS FUNCTION WAS ORIGINALLY CREATED BY RON J. WEISS (Columbia/NYU/Google)
     """
-    # length of beats and segments in seconds
-    # result for track: 'TR0002Q11C3FA8332D'
-    #    seglen.shape = (708,)
-    #    btlen.shape = (304,)
-    #    duration = 238.91546    meaning approx. 3min59s
-    seglen = np.concatenate((segstart[1:], [duration])) - segstart
-    btlen = np.concatenate((btstart[1:], [duration])) - btstart
-
-    warpmat = np.zeros((len(segstart), len(btstart)))
-    # iterate over beats (columns of warpmat)
-    for n in xrange(len(btstart)):
-        # beat start time and end time in seconds
-        start = btstart[n]
-        end = start + btlen[n]
-        # np.nonzero returns index of nonzero elems
-        # find first segment that starts after beat starts - 1
-        try:
-            start_idx = np.nonzero((segstart - start) >= 0)[0][0] - 1
-        except IndexError:
-            # no segment start after that beats, can happen close
-            # to the end, simply ignore, maybe even break?
-            # (catching faster than ckecking... it happens rarely?)
-            break
-        # find first segment that starts after beat ends
-        segs_after = np.nonzero((segstart - end) >= 0)[0]
-        if segs_after.shape[0] == 0:
-            end_idx = start_idx
-        else:
-            end_idx = segs_after[0]
-        # fill col of warpmat with 1 for the elem in between
-        # (including start_idx, excluding end_idx)
-        warpmat[start_idx:end_idx, n] = 1.
-        # if the beat started after the segment, keep the proportion
-        # of the segment that is inside the beat
-        warpmat[start_idx, n] = 1. - ((start - segstart[start_idx])
-                                 / seglen[start_idx])
-        # if the segment ended after the beat ended, keep the proportion
-        # of the segment that is inside the beat
-        if end_idx - 1 > start_idx:
-            warpmat[end_idx-1, n] = ((end - segstart[end_idx-1])
-                                     / seglen[end_idx-1])
-        # normalize so the 'energy' for one beat is one
-        warpmat[:, n] /= np.sum(warpmat[:, n])
-    # return the transpose, meaning (#beats , #segs)
-    return warpmat.T
+    btidx, segidx, weights = get_time_warp_weights(segstart, btstart,
+                                                   duration)
+    warpmat = np.zeros((len(btstart), len(segstart)))
+    warpmat[btidx, segidx] = weights
+    return warpmat
 
 
 def idB(loudness_array):
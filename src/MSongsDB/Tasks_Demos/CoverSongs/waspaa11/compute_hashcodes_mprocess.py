@@ -131,9 +131,10 @@ def my_vacuum(dbpathnew, dbpathold):
     conn.close()
     
 
-def create_fill_one_partial_db(filelist=None, outputdb=None):
+def create_fill_one_partial_db(filelist=None, outputdb=None, btstore=''):
     """
     This is the main function called by each process
+    btstore is an optional store of btchromas (see quick_query_test.open_btstore)
     """
     # assert we have the params
     assert (not filelist is None) and (not outputdb is None), "internal arg passing error...!"
@@ -149,11 +150,14 @@ def create_fill_one_partial_db(filelist=None, outputdb=None):
     conn.execute('PRAGMA journal_mode = OFF;') # no ROLLBACK!
     conn.execute('PRAGMA cache_size = 1000000;') # default=2000, page_size=1024
     CHT.init_db(conn)
+    # btchromas already computed?
+    store = QQT.open_btstore(btstore)
     # iterate over files
     cnt_tid_added = 0
     for filepath in filelist:
         # get bthcroma
-        btchroma = QQT.get_cpressed_btchroma(filepath, compression=COMPRESSION)
+        btchroma = QQT.get_cpressed_btchroma(filepath, compression=COMPRESSION,
+                                             store=store)
         if btchroma is None:
             continue
         # get tid from filepath (faster than querying h5 file, less robust)
@@ -201,7 +205,10 @@ def die_with_usage():
     print 'data, e.g. the whole millin song dataset.'
     print 'Creates as many db as process, then aggregate them into one'
     print 'USAGE'
-    print '   python compute_hashcodes_mprocess.py <maindir> <output.db> <nthreads>'
+    print '   python compute_hashcodes_mprocess.py [FLAGS] <maindir> <output.db> <nthreads>'
+    print 'FLAGS'
+    print '   -btstore d   store of btchromas, see YearPrediction/btfeats_store.py,'
+    print '                built with -compression %d' % COMPRESSION
     sys.exit(0)
 
 
@@ -211,6 +218,16 @@ if __name__ == '__main__':
     if len(sys.argv) < 4:
         die_with_usage()
 
+    # flags
+    btstore = ''
+    while True:
+        if sys.argv[1] == '-btstore':
+            btstore = sys.argv[2]
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+
     # params
     maindir = sys.argv[1]
     outputdb = sys.argv[2]
@@ -248,7 +265,8 @@ if __name__ == '__main__':
         # params for one specific thread
         p = {'outputdb': copy.deepcopy(tmpdbs[k]),
              'filelist': copy.deepcopy(allfiles[files_per_thread * k:
-                                                files_per_thread * (k + 1)])}
+                                                files_per_thread * (k + 1)]),
+             'btstore': btstore}
         params_list.append(p)
     # create pool, launch using the list of params
     # we underuse multiprocessing, we will have as many processes
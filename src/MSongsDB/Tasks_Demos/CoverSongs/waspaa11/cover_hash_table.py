@@ -589,6 +589,7 @@ def die_with_usage():
     print '   python cover_hash_table.py [FLAGS] <datadir> <coverlist> <tmp_db>'
     print 'FLAGS'
     print '  -fulldata    load every file in datadir'
+    print '  -btstore d   store of btchromas, see quick_query_test.open_btstore'
     print ''
     sys.exit(0)
 
@@ -604,9 +605,13 @@ if __name__ == '__main__':
 
     # flags
     fulldata = False
+    btstore = ''
     while True:
         if sys.argv[1] == '-fulldata':
             fulldata = True
+        elif sys.argv[1] == '-btstore':
+            btstore = sys.argv[2]
+            sys.argv.pop(1)
         else:
             break
         sys.argv.pop(1)
@@ -642,6 +647,7 @@ if __name__ == '__main__':
 
     # try to get data in as fast as possible
     clique_tid, clique_name = PC.read_cover_list(coverlistf)
+    store = QQT.open_btstore(btstore)
 
     def get_jumps1(btchroma):
         """
@@ -689,7 +695,8 @@ if __name__ == '__main__':
         filepath = PC.path_from_tid(maindir,tid)
         # get btchromas
         #btchromas = map(lambda p: BAF.get_btchromas(p), filepaths)
-        btchroma = QQT.get_cpressed_btchroma(filepath, compression=COMPRESSION)
+        btchroma = QQT.get_cpressed_btchroma(filepath, compression=COMPRESSION,
+                                             store=store)
         # add jumps
         if btchroma is None:
             continue
@@ -387,9 +387,10 @@ if __name__ == '__main__':
     warnings.filterwarnings('ignore', category=DeprecationWarning)
 
     # get chroma
-    btchroma = BAF.get_btchromas_loudness(songfile)
-    btchroma_db = np.log10(BAF.get_btchromas_loudness(songfile)) * 20.
-    btchroma_normal = BAF.get_btchromas(songfile)
+    btfeats = BAF.get_btfeats(songfile, ('chromas_loudness', 'chromas'))
+    btchroma = btfeats['chromas_loudness']
+    btchroma_db = np.log10(btchroma) * 20.
+    btchroma_normal = btfeats['chromas']
 
     # get landmarks
     landmarks = get_landmarks(btchroma, decay=decay)
@@ -26,6 +26,10 @@ import time
 import sqlite3
 import numpy as np
 
+# where to find btfeats_store.py (store of beat-aligned features)
+YEAR_PRED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'YearPrediction')
+
 # hack to get btchromas
 try:
     import beat_aligned_feats as BAF
@@ -55,10 +59,32 @@ LEVELS = [3] # composed jumps, 1 means first order jumps
 #LEVELS = [1, 4]
 
 
-def get_cpressed_btchroma(path, compression=1):
-    """ to easily play with the btchromas we get """
+def open_btstore(btstore):
+    """
+    Open a store of beat-aligned features (see
+    YearPrediction/btfeats_store.py), None if btstore is ''
+    """
+    if btstore == '':
+        return None
+    if not YEAR_PRED_FOLDER in sys.path:
+        sys.path.append(YEAR_PRED_FOLDER)
+    import btfeats_store as BTSTORE
+    return BTSTORE.BtFeatsStore(btstore)
+
+
+def get_cpressed_btchroma(path, compression=1, store=None):
+    """
+    to easily play with the btchromas we get
+    store is an optional store of beat-aligned chromas (see open_btstore),
+    used when it was aligned with the same compression
+    """
     # MAIN FUNCTION WITH COMPRESSION / STRETCH
     add_loudness = False
+    # btchromas already computed?
+    track_id = os.path.splitext(os.path.basename(path))[0]
+    if (store is not None and store.compression == compression
+        and not add_loudness and track_id in store):
+        return store.get_btfeat('chromas', track_id)
     h5 = BAF.GETTERS.open_h5_file_read(path)
     chromas = BAF.GETTERS.get_segments_pitches(h5)
     segstarts = BAF.GETTERS.get_segments_start(h5)
@@ -168,13 +194,14 @@ def get_jumps(btchroma, verbose=0):
     return jumps
 
 
-def one_exp(maindir, clique_tid, verbose=0):
+def one_exp(maindir, clique_tid, verbose=0, store=None):
     """
     performs one experiment:
       - select two covers
       - select random song
       - computes hashes / jumps
       - return 1 if we return cover correctly, 0 otherwise
+    store is an optional store of btchromas (see open_btstore)
     """
     # select cliques
     cliques = sorted(clique_tid.keys())
@@ -202,11 +229,14 @@ def one_exp(maindir, clique_tid, verbose=0):
     for cid, compression in enumerate(COMPRESSION):
         # get btchromas
         query_path = path_from_tid(maindir, query)
-        query_btc = get_cpressed_btchroma(query_path, compression=compression)
+        query_btc = get_cpressed_btchroma(query_path, compression=compression,
+                                          store=store)
         good_ans_path = path_from_tid(maindir, good_ans)
-        good_ans_btc = get_cpressed_btchroma(good_ans_path, compression=compression)
+        good_ans_btc = get_cpressed_btchroma(good_ans_path, compression=compression,
+                                             store=store)
         bad_ans_path = path_from_tid(maindir, bad_ans)
-        bad_ans_btc = get_cpressed_btchroma(bad_ans_path, compression=compression)
+        bad_ans_btc = get_cpressed_btchroma(bad_ans_path, compression=compression,
+                                            store=store)
         if query_btc is None or good_ans_btc is None or bad_ans_btc is None:
             conn.close()
             return None
@@ -284,7 +314,10 @@ def die_with_usage():
     print 'Performs a few quick experiments to easily compare hashing'
     print 'methods without a full experiment.'
     print 'USAGE:'
-    print '     python quick_query_test.py <maindir> <coverlist> <OPT: comment>'
+    print '     python quick_query_test.py [FLAGS] <maindir> <coverlist> <OPT: comment>'
+    print 'FLAGS:'
+    print '     -btstore d  - store of btchromas, see YearPrediction/btfeats_store.py,'
+    print '                   built with -compression as in COMPRESSION'
     sys.exit(0)
 
 
@@ -294,6 +327,16 @@ if __name__ == '__main__':
     if len(sys.argv) < 3:
         die_with_usage()
 
+    # flags
+    btstore = ''
+    while True:
+        if sys.argv[1] == '-btstore':
+            btstore = sys.argv[2]
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+
     # params
     maindir = sys.argv[1]
     coverlistf = sys.argv[2]
@@ -309,6 +352,9 @@ if __name__ == '__main__':
     # read cliques        
     clique_tid, clique_name = read_cover_list(coverlistf)
 
+    # btchromas already computed?
+    store = open_btstore(btstore)
+
     # set random seed
     np.random.seed(RANDOMSEED)
 
@@ -331,7 +377,7 @@ if __name__ == '__main__':
         if (cnt_exps + 1) % 25 == 0:
             verbose = 1
         try:
-            res = one_exp(maindir, clique_tid, verbose=verbose)
+            res = one_exp(maindir, clique_tid, verbose=verbose, store=store)
         except KeyboardInterrupt:
             break
         if res is None:
@@ -0,0 +1,253 @@
+"""
+Code to compute beat-aligned features (chromas, timbre, loudness, see
+beat_aligned_feats.py) of many songs once, and store them on disk keyed by
+track_id and feature, so experiments can read them back instead of
+aligning the segments of every song again.
+
+The store is a directory in the flat NumPy format of hdf5_to_npy.py:
+for each feature, <feature>.values.npy holds the features of all songs,
+one row per beat, and <feature>.offsets.npy where each song starts.
+It is read memory-mapped, the features of a song are a view into it.
+Songs whose features can not be computed (e.g. no beats) have no beats.
+A store can be aligned on every n-th beat only (its compression, as in
+CoverSongs/waspaa11/quick_query_test.py), this is kept in its manifest.
+
+This is part of the Million Song Dataset project from
+LabROSA (Columbia University) and The Echo Nest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sys
+import time
+import datetime
+import itertools
+import multiprocessing
+import numpy as np
+import beat_aligned_feats as BAF
+try:
+    import hdf5_getters as GETTERS
+    import hdf5_to_npy as NPY
+except ImportError:
+    print 'cannot find file hdf5_getters.py or hdf5_to_npy.py'
+    print 'you must put MSongsDB/PythonSrc in your path or import it otherwise'
+    raise
+
+
+def align_songs(h5filename,start,stop,featnames,compression=1):
+    """
+    Compute the beat-aligned features of songs start to stop (None for all)
+    of a song file or aggregate file, on every compression-th beat.
+    RETURN
+       track_ids  - track_id of each song
+       durations  - duration of each song
+       btfeats    - dictionary featname -> (features, one row per beat,
+                    number of beats of each song)
+    """
+    songidxs = slice(start,stop)
+    h5 = GETTERS.open_h5_file_read(h5filename)
+    try:
+        track_ids = GETTERS.read_scalar_batch(h5,'track_id',songidxs)
+        durations = GETTERS.read_scalar_batch(h5,'duration',songidxs)
+        btfeats,offsets = BAF.get_btfeats_batch(h5,featnames,songidxs,
+                                                compression=compression)
+    finally:
+        h5.close()
+    lengths = np.diff(offsets)
+    for featname in featnames:
+        btfeats[featname] = (np.ascontiguousarray(btfeats[featname].T),lengths)
+    return track_ids,durations,btfeats
+
+
+def align_songs_wrapper(args):
+    """ wrapper function for multiprocessor, calls align_songs """
+    return align_songs(**args)
+
+
+def fill_btfeats_store(h5_filenames,outdir,featnames=BAF.BTFEATS,nworkers=1,bufsize=100,
+                       compression=1):
+    """
+    Compute the beat-aligned features of the songs of HDF5 song files
+    (or of one aggregate file) and write them to a store in outdir,
+    aligned on every compression-th beat.
+    Songs are aligned one file at a time, or bufsize songs at a time for
+    an aggregate file, by nworkers processes (0 for one per core),
+    and written in the order of the files.
+    RETURN
+       number of songs in the store
+    """
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    # remove a previous manifest, the store is not valid until done
+    if os.path.isfile(os.path.join(outdir,NPY.MANIFEST)):
+        os.remove(os.path.join(outdir,NPY.MANIFEST))
+    if nworkers < 1:
+        nworkers = multiprocessing.cpu_count()
+    # one task per song file, or per bufsize songs of an aggregate file
+    params_list = []
+    if len(h5_filenames) == 1:
+        h5 = GETTERS.open_h5_file_read(h5_filenames[0])
+        nSongs = GETTERS.get_num_songs(h5)
+        h5.close()
+        for start in xrange(0,nSongs,bufsize):
+            params_list.append({'h5filename':h5_filenames[0],'start':start,
+                                'stop':min(start+bufsize,nSongs),
+                                'featnames':featnames,'compression':compression})
+    else:
+        for h5filename in h5_filenames:
+            params_list.append({'h5filename':h5filename,'start':0,'stop':None,
+                                'featnames':featnames,'compression':compression})
+    writers = {}
+    lengths = dict((f,[]) for f in featnames)
+    scalars = dict((f,[]) for f in NPY.NPY_SCALAR_FIELDS)
+    pool = None
+    try:
+        if nworkers == 1:
+            results = itertools.imap(align_songs_wrapper,params_list)
+        else:
+            pool = multiprocessing.Pool(processes=nworkers)
+            chunksize = max(1,min(16,len(params_list) // (nworkers * 4)))
+            results = pool.imap(align_songs_wrapper,params_list,chunksize)
+        for track_ids,durations,btfeats in results:
+            scalars['track_id'].append(track_ids)
+            scalars['duration'].append(durations)
+            for featname in featnames:
+                values,songlengths = btfeats[featname]
+                if not featname in writers:
+                    writers[featname] = NPY.NpyAppender(
+                        os.path.join(outdir,featname+'.values.npy'),
+                        values.dtype,values.shape[1:])
+                writers[featname].append(values)
+                lengths[featname].append(songlengths)
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        for writer in writers.values():
+            writer.close()
+    return NPY.finish_npy_export(outdir,scalars,lengths,featnames,
+                                 extra={'compression':compression})
+
+
+class BtFeatsStore(NPY.NpyDataset):
+    """
+    Read a store of beat-aligned features written by fill_btfeats_store,
+    nothing is copied or aligned. Features are aligned on every
+    store.compression-th beat.
+    """
+    def __init__(self,path):
+        NPY.NpyDataset.__init__(self,path)
+        self.compression = self.manifest.get('compression',1)
+
+    def __contains__(self,track_id):
+        try:
+            self.position(track_id)
+        except KeyError:
+            return False
+        return True
+
+    def get_btfeat(self,featname,track_id):
+        """
+        Get a beat-aligned feature of a song, by track_id, as a read-only
+        view, one beat per column (as beat_aligned_feats.py)
+        or None if it could not be computed (e.g. no beats).
+        Raise a KeyError if the song or the feature is not in the store.
+        """
+        btfeat = self.get(featname,track_id)
+        if btfeat.shape[0] == 0:
+            return None
+        return btfeat.T
+
+
+def get_btfeat(featname,h5,track_id,store=None):
+    """
+    Get a beat-aligned feature of a song from a store (see BtFeatsStore)
+    if it is in there, else compute it from the song file h5
+    (filename or open h5 file), on the beats of the store.
+    """
+    if store is None:
+        return BAF.get_btfeats(h5,(featname,))[featname]
+    if track_id in store:
+        return store.get_btfeat(featname,track_id)
+    return BAF.get_btfeats(h5,(featname,),compression=store.compression)[featname]
+
+
+def die_with_usage():
+    """ HELP MENU """
+    print 'btfeats_store.py'
+    print 'Compute the beat-aligned features of song files (or aggregate'
+    print 'files) once, and store them keyed by track_id, see BtFeatsStore'
+    print 'to read them.'
+    print ' '
+    print 'usage:'
+    print '   python btfeats_store.py [FLAGS] <DIR/FILE> <OUTPUT DIR>'
+    print 'PARAM'
+    print '   <DIR/FILE>    an aggregate file, or a dir with .h5 files in its subdirectories'
+    print '   <OUTPUT DIR>  where to write the store'
+    print 'FLAGS'
+    print '   -feats F1,F2  features to store, default: '+','.join(BAF.BTFEATS)
+    print '   -workers n    number of processes (0 for one per core), default: 1'
+    print '   -compression n  align on every n-th beat (see CoverSongs), default: 1'
+    sys.exit(0)
+
+if __name__ == '__main__':
+
+    # HELP MENU
+    if len(sys.argv) < 3:
+        die_with_usage()
+
+    # FLAGS
+    featnames = BAF.BTFEATS
+    nworkers = 1
+    compression = 1
+    while True:
+        if sys.argv[1] == '-feats':
+            featnames = sys.argv[2].split(',')
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-workers':
+            nworkers = int(sys.argv[2])
+            sys.argv.pop(1)
+        elif sys.argv[1] == '-compression':
+            compression = int(sys.argv[2])
+            sys.argv.pop(1)
+        else:
+            break
+        sys.argv.pop(1)
+    for featname in featnames:
+        if not featname in BAF.BTFEATS:
+            print 'unknown beat-aligned feature:',featname
+            sys.exit(0)
+
+    # GET DIR/FILE
+    if os.path.isfile(sys.argv[1]):
+        allh5files = [ os.path.abspath(sys.argv[1]) ]
+    elif os.path.isdir(sys.argv[1]):
+        allh5files = sorted(NPY.get_all_files(sys.argv[1],ext='.h5'))
+    else:
+        print 'file or dir:',sys.argv[1],'does not exist.'
+        sys.exit(0)
+    outdir = sys.argv[2]
+
+    # let's go!
+    t1 = time.time()
+    nrows = fill_btfeats_store(allh5files,outdir,featnames=featnames,nworkers=nworkers,
+                               compression=compression)
+    stimelength = str(datetime.timedelta(seconds=time.time()-t1))
+    print 'stored',nrows,'songs from',len(allh5files),'files in',outdir,'in',stimelength
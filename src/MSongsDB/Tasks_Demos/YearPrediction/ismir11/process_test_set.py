@@ -44,7 +44,7 @@ import year_pred_benchmark as BENCHMARK
 import randproj as RANDPROJ
 for p in YEAR_REC_FOLDERS:
     sys.path.append(p)
-from beat_aligned_feats import get_bttimbre
+import btfeats_store as BTSTORE
 try:
     import scikits.ann as ANN
 except ImportError:
@@ -90,7 +90,7 @@ def do_prediction(processed_feats,kd,h5model,K=1):
 
 def process_filelist_test(filelist=None,model=None,tmpfilename=None,
                            npicks=None,winsize=None,finaldim=None,K=1,
-                          typecompress='picks'):
+                          typecompress='picks',btstore=''):
     """
     Main function, process all files in the list (as long as their artist
     is in testartist)
@@ -104,6 +104,7 @@ def process_filelist_test(filelist=None,model=None,tmpfilename=None,
        K            - param of KNN (default 1)
        typecompress - feature type, 'picks', 'corrcoeff' or 'cov'
                       must be the same as in training
+       btstore      - store of beat-aligned timbre (see btfeats_store.py), '' if none
     """
     # sanity check
     for arg in locals().values():
@@ -135,6 +136,14 @@ def process_filelist_test(filelist=None,model=None,tmpfilename=None,
         randproj = RANDPROJ.proj_point5(90, finaldim)
     else:
         assert False,'Unknown type of compression: '+str(typecompress)
+    # beat-aligned timbre from a store when there is one
+    store = None
+    if btstore != '':
+        store = BTSTORE.BtFeatsStore(btstore)
+        assert store.compression == 1,'btstore not aligned on every beat: '+btstore
+    # each song file is opened for its metadata then for its features,
+    # keep the last one open
+    GETTERS.set_h5_cache_size(1)
     # go through files
     cnt_f = 0
     for f in filelist:
@@ -151,7 +160,7 @@ def process_filelist_test(filelist=None,model=None,tmpfilename=None,
             continue
         if typecompress == 'picks':
             # we have a train artist with a song year, we're good
-            bttimbre = get_bttimbre(f)
+            bttimbre = BTSTORE.get_btfeat('timbre',f,track_id,store)
             if bttimbre is None:
                 continue
             # we even have normal features, awesome!
@@ -184,6 +193,7 @@ def process_filelist_test(filelist=None,model=None,tmpfilename=None,
         if not year_pred is None:
             output.root.data.year_real.append( [year] )
             output.root.data.year_pred.append( [year_pred] )
+    GETTERS.clear_h5_cache()
     # close output and model
     del kd
     h5model.close()
@@ -201,7 +211,8 @@ def process_filelist_test_wrapper(args):
 
 
 def process_filelist_test_main_pass(nthreads,model,testsongs,
-                                    npicks,winsize,finaldim,K,typecompress):
+                                    npicks,winsize,finaldim,K,typecompress,
+                                    btstore=''):
     """
     Do the main walk through the data, deals with the threads,
     creates the tmpfiles.
@@ -214,6 +225,7 @@ def process_filelist_test_main_pass(nthreads,model,testsongs,
       - finaldim     - final dimension of the sample, something like 5?
       - K            - K-nn parameter
       - typecompress - feature type, 'picks', 'corrcoeff', 'cov'
+      - btstore      - store of beat-aligned timbre, '' if none
     RETURN
       - tmpfiles     - list of tmpfiles that were created
                        or None if something went wrong
@@ -223,7 +235,8 @@ def process_filelist_test_main_pass(nthreads,model,testsongs,
     # prepare params for each thread
     params_list = []
     default_params = {'npicks':npicks,'winsize':winsize,'finaldim':finaldim,
-                      'model':model,'K':K,'typecompress':typecompress}
+                      'model':model,'K':K,'typecompress':typecompress,
+                      'btstore':btstore}
     tmpfiles_stub = 'mainpasstest_tmp_output_win'+str(winsize)+'_np'+str(npicks)+'_fd'+str(finaldim)+'_'+typecompress+'_'
     tmpfiles = map(lambda x: os.path.join(os.path.abspath('.'),tmpfiles_stub+str(x)+'.h5'),range(nthreads))
     nfiles_per_thread = int(np.ceil(len(testsongs) * 1. / nthreads))
@@ -255,7 +268,7 @@ def process_filelist_test_main_pass(nthreads,model,testsongs,
     return tmpfiles
 
 
-def test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress):
+def test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress,btstore=''):
     """
     Main function to do the testing
     Do the main pass with the number of given threads.
@@ -269,6 +282,7 @@ def test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress):
       - finaldim     - final dimension of the sample, something like 5?
       - K            - K-nn parameter
       - typecompress - feature type, one of: 'picks', 'corrcoeff', 'cov'
+      - btstore      - store of beat-aligned timbre, '' if none
     RETURN
        - nothing
     """
@@ -277,7 +291,7 @@ def test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress):
     # do main pass
     tmpfiles = process_filelist_test_main_pass(nthreads,model,testsongs,
                                                npicks,winsize,finaldim,K,
-                                               typecompress)
+                                               typecompress,btstore)
                                                
     if tmpfiles is None:
         print 'Something went wrong, tmpfiles are None'
@@ -326,6 +340,7 @@ def die_with_usage():
     print '     -winsize n  - windows size in beats for each pick'
     print '    -finaldim n  - final dimension after random projection'
     print '-typecompress s  - type of features, "picks", "corrcoeff" or "cov"'
+    print '     -btstore d  - store of beat-aligned timbre, see btfeats_store.py'
     sys.exit(0)
 
 
@@ -342,6 +357,7 @@ if __name__ == '__main__':
     finaldim = 5
     K = 1
     typecompress = 'picks'
+    btstore = ''
     while True:
         if sys.argv[1] == '-nthreads':
             nthreads = int(sys.argv[2])
@@ -361,6 +377,9 @@ if __name__ == '__main__':
         elif sys.argv[1] == '-typecompress':
             typecompress = sys.argv[2]
             sys.argv.pop(1)
+        elif sys.argv[1] == '-btstore':
+            btstore = sys.argv[2]
+            sys.argv.pop(1)
         else:
             break
         sys.argv.pop(1)
@@ -389,6 +408,7 @@ if __name__ == '__main__':
     print 'finaldim:',finaldim
     print 'K:',K
     print 'typecompress:',typecompress
+    print 'btstore:',btstore
     print '***********************************'
 
     # read test artists
@@ -420,7 +440,7 @@ if __name__ == '__main__':
     assert os.path.isfile(testsongs[0]),'first testing file does not exist? '+testsongs[0]
 
     # launch testing
-    test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress)
+    test(nthreads,model,testsongs,npicks,winsize,finaldim,K,typecompress,btstore)
     
     # done
     print 'DONE!'
@@ -43,7 +43,7 @@ import compress_feat as CBTF
 import randproj as RANDPROJ
 for p in YEAR_REC_FOLDERS:
     sys.path.append(p)
-from beat_aligned_feats import get_bttimbre
+import btfeats_store as BTSTORE
 
 
 # error passing problems, useful for multiprocessing
@@ -87,7 +87,8 @@ def apply_to_all_files(basedir,func=lambda x: x,ext='.h5'):
 
 
 def process_filelist_train(filelist=None,testartists=None,tmpfilename=None,
-                           npicks=None,winsize=None,finaldim=None,typecompress='picks'):
+                           npicks=None,winsize=None,finaldim=None,typecompress='picks',
+                           btstore=''):
     """
     Main function, process all files in the list (as long as their artist
     is not in testartist)
@@ -100,6 +101,7 @@ def process_filelist_train(filelist=None,testartists=None,tmpfilename=None,
        finaldim     - how many values do we keep
        typecompress - one of 'picks' (win of btchroma), 'corrcoef' (correlation coefficients),
                       'cov' (covariance)
+       btstore      - store of beat-aligned timbre (see btfeats_store.py), '' if none
     """
     # sanity check
     for arg in locals().values():
@@ -126,6 +128,14 @@ def process_filelist_train(filelist=None,testartists=None,tmpfilename=None,
         randproj = RANDPROJ.proj_point5(90, finaldim)
     else:
         assert False,'Unknown type of compression: '+str(typecompress)
+    # beat-aligned timbre from a store when there is one
+    store = None
+    if btstore != '':
+        store = BTSTORE.BtFeatsStore(btstore)
+        assert store.compression == 1,'btstore not aligned on every beat: '+btstore
+    # each song file is opened for its metadata then for its features,
+    # keep the last one open
+    GETTERS.set_h5_cache_size(1)
     # iterate over files
     cnt_f = 0
     for f in filelist:
@@ -142,7 +152,7 @@ def process_filelist_train(filelist=None,testartists=None,tmpfilename=None,
         if year <= 0 or artist_id in testartists:
             continue
         # we have a train artist with a song year, we're good
-        bttimbre = get_bttimbre(f)
+        bttimbre = BTSTORE.get_btfeat('timbre',f,track_id,store)
         if typecompress == 'picks':
             if bttimbre is None:
                 continue
@@ -171,6 +181,7 @@ def process_filelist_train(filelist=None,testartists=None,tmpfilename=None,
         output.root.data.year.append( np.array( [year] * n_p_feats ) )
         output.root.data.track_id.append( np.array( [track_id] * n_p_feats ) )
         output.root.data.feats.append( processed_feats )
+    GETTERS.clear_h5_cache()
     # we're done, close output
     output.close()
     return
@@ -186,7 +197,7 @@ def process_filelist_train_wrapper(args):
 
 def process_filelist_train_main_pass(nthreads,maindir,testartists,
                                      npicks,winsize,finaldim,trainsongs=None,
-                                     typecompress='picks'):
+                                     typecompress='picks',btstore=''):
     """
     Do the main walk through the data, deals with the threads,
     creates the tmpfiles.
@@ -199,6 +210,7 @@ def process_filelist_train_main_pass(nthreads,maindir,testartists,
       - finaldim     - final dimension of the sample, something like 5?
       - trainsongs   - list of files to use for training
       - typecompress - 'picks', 'corrcoeff', 'cov'
+      - btstore      - store of beat-aligned timbre, '' if none
     RETURN
       - tmpfiles     - list of tmpfiles that were created
                        or None if something went wrong
@@ -221,7 +233,8 @@ def process_filelist_train_main_pass(nthreads,maindir,testartists,
     # prepare params for each thread
     params_list = []
     default_params = {'npicks':npicks,'winsize':winsize,'finaldim':finaldim,
-                      'testartists':testartists,'typecompress':typecompress}
+                      'testartists':testartists,'typecompress':typecompress,
+                      'btstore':btstore}
     tmpfiles_stub = 'mainpass_tmp_output_win'+str(winsize)+'_np'+str(npicks)+'_fd'+str(finaldim)+'_'+typecompress+'_'
     tmpfiles = map(lambda x: os.path.join(os.path.abspath('.'),tmpfiles_stub+str(x)+'.h5'),range(nthreads))
     nfiles_per_thread = int(np.ceil(len(allfiles) * 1. / nthreads))
@@ -254,7 +267,8 @@ def process_filelist_train_main_pass(nthreads,maindir,testartists,
 
 
 
-def train(nthreads,maindir,output,testartists,npicks,winsize,finaldim,trainsongs=None,typecompress='picks'):
+def train(nthreads,maindir,output,testartists,npicks,winsize,finaldim,trainsongs=None,typecompress='picks',
+          btstore=''):
     """
     Main function to do the training
     Do the main pass with the number of given threads.
@@ -269,6 +283,7 @@ def train(nthreads,maindir,output,testartists,npicks,winsize,finaldim,trainsongs
       - finaldim     - final dimension of the sample, something like 5?
       - trainsongs   - list of songs to use for training
       - typecompress - 'picks', 'corrcoeff' or 'cov'
+      - btstore      - store of beat-aligned timbre, '' if none
     RETURN
        - nothing
     """
@@ -281,7 +296,8 @@ def train(nthreads,maindir,output,testartists,npicks,winsize,finaldim,trainsongs
     # do main pass
     tmpfiles = process_filelist_train_main_pass(nthreads,maindir,testartists,
                                                 npicks,winsize,finaldim,
-                                                trainsongs=trainsongs,typecompress=typecompress)
+                                                trainsongs=trainsongs,typecompress=typecompress,
+                                                btstore=btstore)
     if tmpfiles is None:
         print 'Something went wrong, tmpfiles are None'
         return
@@ -341,6 +357,7 @@ def die_with_usage():
     print '    -finaldim n  - final dimension after random projection'
     print '        -tmdb f  - path to track_metadata.db, makes things faster'
     print '-typecompress s  - actual features we use, "picks", "corrcoeff" or "cov"'
+    print '     -btstore d  - store of beat-aligned timbre, see btfeats_store.py'
     sys.exit(0)
 
 
@@ -358,6 +375,7 @@ if __name__ == '__main__':
     finaldim = 5
     tmdb = ''
     typecompress = 'picks'
+    btstore = ''
     while True:
         if sys.argv[1] == '-nthreads':
             nthreads = int(sys.argv[2])
@@ -380,6 +398,9 @@ if __name__ == '__main__':
         elif sys.argv[1] == '-typecompress':
             typecompress = sys.argv[2]
             sys.argv.pop(1)
+        elif sys.argv[1] == '-btstore':
+            btstore = sys.argv[2]
+            sys.argv.pop(1)
         else:
             break
         sys.argv.pop(1)
@@ -436,6 +457,7 @@ if __name__ == '__main__':
     print 'finaldim:',finaldim
     print 'tmdb:',tmdb
     print 'typecompress:',typecompress
+    print 'btstore:',btstore
 
     # sanity check
     if not os.path.isdir(msd_dir):
@@ -446,7 +468,8 @@ if __name__ == '__main__':
         sys.exit(0)
 
     # launch training
-    train(nthreads,msd_dir,output,testartists_set,npicks,winsize,finaldim,trainsongs,typecompress)
+    train(nthreads,msd_dir,output,testartists_set,npicks,winsize,finaldim,trainsongs,typecompress,
+          btstore)
 
     # done
     print 'DONE!'
@@ -1,21 +1,310 @@
 import os
 import datetime
+import hashlib
+import httplib
+import json
+import numpy as np
 import pandas as pd
+import resource
+import shutil
 import sqlite3
+import tempfile
+import threading
+import time
 import urllib
+import urllib2
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 import lxml.html
 
-def execute_query(db_path, db_name, query):
+# Instrumentation
+#
+# Named timers, counters and peak RSS snapshots for the data pipeline,
+# reported as JSON at the end of a run. Everything is a no-op until
+# enable() is called, instrumented code only pays an attribute check.
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class _Timer(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.add_time(self.name, time.time() - self.start)
+        return False
+
+class Instrumentation(object):
+    ### Process-local timers, counters and RSS snapshots
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.timers = dict()
+        self.counters = dict()
+        self.rss = list()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def timer(self, name):
+        # Use as: with INSTRUMENTATION.timer('sql'): ...
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def add_time(self, name, seconds):
+        total, calls = self.timers.get(name, (0.0, 0))
+        self.timers[name] = (total + seconds, calls + 1)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot_rss(self, label):
+        # Peak resident set size so far, of this process and of its
+        # finished children (e.g. pool workers), in KiB on Linux
+        if self.enabled:
+            self.rss.append({
+                'label': label,
+                'peak_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss,
+                'peak_children_rss_kb': resource.getrusage(
+                    resource.RUSAGE_CHILDREN).ru_maxrss,
+            })
+
+    def stats(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters)}
+
+    def merge(self, stats):
+        # Adds the stats() of another process, e.g. a pool worker
+        for name, (seconds, calls) in stats['timers'].items():
+            total, total_calls = self.timers.get(name, (0.0, 0))
+            self.timers[name] = (total + seconds, total_calls + calls)
+        for name, n in stats['counters'].items():
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        timers = dict((name, {'seconds': seconds, 'calls': calls})
+                      for name, (seconds, calls) in self.timers.items())
+        return {'timers': timers, 'counters': dict(self.counters),
+                'rss': list(self.rss)}
+
+    def save_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+_NULL_TIMER = _NullTimer()
+INSTRUMENTATION = Instrumentation()
+
+# SQLite connections
+#
+# The MSD databases are never written to, so connections are opened read
+# only and kept open for the life of the process (per database and per
+# process, connections must not be shared with forked children). The
+# page cache then stays warm across the many small queries we issue.
+
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHE_SIZE = -64 * 1024 # in KiB when negative, i.e. 64 MiB
+
+_connections = dict()
+
+def _read_only_uri(path):
+    # immutable=1 (SQLite 3.8.0+) also skips locking, the files never change
+    uri = 'file:{0}?mode=ro'.format(urllib.pathname2url(path))
+    if sqlite3.sqlite_version_info >= (3, 8, 0):
+        uri += '&immutable=1'
+    return uri
+
+def _check_database(path):
+    if not os.path.isfile(path):
+        raise IOError('no such database: {0}'.format(path))
+
+def _connect_read_only(path):
+    # Returns the connection and whether it takes URI filenames
+    _check_database(path)
+    try:
+        con = sqlite3.connect(_read_only_uri(path), uri=True,
+                              check_same_thread=False)
+        return con, True
+    except TypeError:
+        # No URI filenames in this sqlite3 module (Python 2), have SQLite
+        # refuse writes instead, to the attached databases as well
+        con = sqlite3.connect(path, check_same_thread=False)
+        con.execute('PRAGMA query_only = ON')
+        return con, False
+
+def get_connection(db_path, db_name, attach=None):
+    ### Returns a cached read-only connection to a SQLite database
+    #
+    # attach maps schema names to other database files in db_path, which
+    # are attached read-only to the connection,
+    # e.g. {'terms_db': 'artist_term.db'}
+    path = os.path.abspath(os.path.join(db_path, db_name))
+    attached = tuple(sorted((attach or dict()).items()))
+    key = (os.getpid(), path, attached)
+    con = _connections.get(key)
+    if con is None:
+        con, uri = _connect_read_only(path)
+        con.execute('PRAGMA mmap_size = {0:d}'.format(SQLITE_MMAP_SIZE))
+        con.execute('PRAGMA cache_size = {0:d}'.format(SQLITE_CACHE_SIZE))
+        for schema, other_name in attached:
+            other = os.path.abspath(os.path.join(db_path, other_name))
+            _check_database(other)
+            if uri:
+                other = _read_only_uri(other)
+            con.execute('ATTACH DATABASE ? AS {0}'.format(schema), (other,))
+        _connections[key] = con
+    return con
+
+def close_connections():
+    ### Closes every cached connection of this process
+    for key in [key for key in _connections if key[0] == os.getpid()]:
+        _connections.pop(key).close()
+
+def execute_query(db_path, db_name, query, params=None, attach=None):
     ### Returns a DataFrame containing the query results
+    #
+    # Pass values through params (? placeholders) instead of formatting
+    # them into the query
 
     # Read sqlite query results into a pandas DataFrame
-    con = sqlite3.connect(os.path.join(db_path, db_name))
-    df = pd.read_sql_query(query, con)
-    con.close()
-
+    with INSTRUMENTATION.timer('sql'):
+        con = get_connection(db_path, db_name, attach)
+        df = pd.read_sql_query(query, con, params=params)
+    INSTRUMENTATION.count('sql_queries')
+    INSTRUMENTATION.count('sql_rows', len(df))
     return df
 
+def iter_query(db_path, db_name, query, params=None, attach=None,
+               chunksize=10000):
+    ### Yields the query results as DataFrames of up to chunksize rows
+    with INSTRUMENTATION.timer('sql'):
+        con = get_connection(db_path, db_name, attach)
+        chunks = pd.read_sql_query(query, con, params=params,
+                                   chunksize=chunksize)
+    INSTRUMENTATION.count('sql_queries')
+    while True:
+        with INSTRUMENTATION.timer('sql'):
+            df = next(chunks, None)
+        if df is None:
+            break
+        INSTRUMENTATION.count('sql_rows', len(df))
+        yield df
+
+# Columnar dataset format
+#
+# A dataset is a directory holding one .npy file per scalar column and,
+# for columns whose cells are arrays (segments_timbre, beats_start, ...),
+# a flat values buffer with every song's array concatenated along the
+# first axis plus an int64 offsets array: song i owns
+# values[offsets[i]:offsets[i+1]]. manifest.json lists the columns in
+# order. An export is written to a temporary directory next to path and
+# renamed into place once complete, so an interrupted (re-)export never
+# leaves a manifest over a mix of old and new columns.
+
+COLUMNAR_MANIFEST = 'manifest.json'
+
+def _write_columnar(df, path):
+    columns = list()
+    for name in df.columns:
+        cells = df[name].tolist()
+        if len(cells) > 0 and isinstance(cells[0], np.ndarray):
+            lengths = np.array([len(cell) for cell in cells], dtype=np.int64)
+            offsets = np.zeros(len(cells) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(os.path.join(path, name + '.values.npy'),
+                    np.concatenate(cells))
+            np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+            columns.append({'name': name, 'kind': 'ragged'})
+        else:
+            np.save(os.path.join(path, name + '.npy'), np.asarray(cells))
+            columns.append({'name': name, 'kind': 'scalar'})
+
+    with open(os.path.join(path, COLUMNAR_MANIFEST), 'w') as f:
+        json.dump({'nrows': len(df), 'columns': columns}, f, indent=1)
+
+def export_columnar(df, path):
+    ### Writes a DataFrame to path in the columnar dataset format
+    #
+    # A dataset already at path is replaced as a whole.
+    path = os.path.abspath(path)
+    parent, base = os.path.split(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+
+    tmp_path = tempfile.mkdtemp(prefix=base + '.', suffix='.tmp', dir=parent)
+    try:
+        _write_columnar(df, tmp_path)
+    except:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    # mkdtemp makes the directory private, give it os.makedirs' mode
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0777 & ~umask)
+
+    if os.path.isdir(path):
+        old_path = tempfile.mkdtemp(prefix=base + '.', suffix='.old',
+                                    dir=parent)
+        os.rmdir(old_path)
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        os.rename(tmp_path, path)
+
+def read_columnar_manifest(path):
+    ### Returns the manifest of a columnar dataset
+    with open(os.path.join(path, COLUMNAR_MANIFEST)) as f:
+        return json.load(f)
+
+def load_ragged(path, column, mmap=True):
+    ### Returns the (values, offsets) pair of an array column
+    #
+    # With mmap=True the values buffer is memory-mapped read-only, so
+    # nothing is read from disk until a song's slice is touched.
+    mmap_mode = 'r' if mmap else None
+    values = np.load(os.path.join(path, column + '.values.npy'),
+                     mmap_mode=mmap_mode)
+    offsets = np.load(os.path.join(path, column + '.offsets.npy'))
+    return values, offsets
+
+def load_columnar(path, columns=None, mmap=True):
+    ### Returns a DataFrame with the requested columns of a dataset
+    #
+    # Only the files of the requested columns are opened. Array columns
+    # hold zero-copy views into their (memory-mapped) values buffer.
+    manifest = read_columnar_manifest(path)
+    kinds = dict((c['name'], c['kind']) for c in manifest['columns'])
+    if columns is None:
+        columns = [c['name'] for c in manifest['columns']]
+    unknown = [name for name in columns if name not in kinds]
+    if unknown:
+        raise KeyError('unknown columns: {0}'.format(', '.join(unknown)))
+
+    data = dict()
+    for name in columns:
+        if kinds[name] == 'ragged':
+            values, offsets = load_ragged(path, name, mmap=mmap)
+            data[name] = [values[offsets[i]:offsets[i + 1]]
+                          for i in xrange(manifest['nrows'])]
+        else:
+            data[name] = np.load(os.path.join(path, name + '.npy'),
+                                 allow_pickle=True)
+    return pd.DataFrame(data, columns=columns)
+
 # the following function simply gives us a nice string for
 # a time lag in seconds
 def strtimedelta(starttime, stoptime):
@@ -25,10 +314,13 @@ def strtimedelta(starttime, stoptime):
 #
 # Script to download lyrics from http://lyrics.wikia.com/
 
+LYRICS_BASE_URL = 'http://lyrics.wikia.com/'
+
 class Song(object):
-    def __init__(self, artist, title):
+    def __init__(self, artist, title, base_url=LYRICS_BASE_URL):
         self.artist = self.__format_str(artist)
         self.title = self.__format_str(title)
+        self.base_url = base_url
         self.url = None
         self.lyric = None
 
@@ -45,16 +337,39 @@ class Song(object):
         return s
 
     def __quote(self, s):
-#          return urlparse.quote(s.replace(' ', '_'))
-        return s.replace(' ', '_')
+        # percent-encode the UTF-8 bytes, urllib2 refuses non-ASCII URLs
+        s = s.replace(' ', '_')
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        return urllib.quote(s)
 
     def __make_url(self):
         artist = self.__quote(self.artist)
         title = self.__quote(self.title)
         artist_title = '%s:%s' %(artist, title)
-        url = 'http://lyrics.wikia.com/' + artist_title
+        url = self.base_url + artist_title
         self.url = url
 
+    def get_url(self):
+        self.__make_url()
+        return self.url
+
+    @staticmethod
+    def parse_lyrics(root):
+        # Returns the lyrics in a parsed lyrics page, None if it has none
+        try:
+            lyricbox = root.cssselect('.lyricbox')[0]
+        except IndexError:
+            return None
+        lyrics = []
+
+        for node in lyricbox:
+            if node.tag == 'br':
+                lyrics.append('\n')
+            if node.tail is not None:
+                lyrics.append(node.tail)
+        return "".join(lyrics).strip()
+
     def update(self, artist=None, title=None):
         if artist:
             self.artist = self.__format_str(artist)
@@ -65,16 +380,104 @@ class Song(object):
         self.__make_url()
         try:
             doc = lxml.html.parse(self.url)
-            lyricbox = doc.getroot().cssselect('.lyricbox')[0]
-        except (IOError, IndexError) as e:
+        except IOError as e:
             self.lyric = ''
             return self.lyric
-        lyrics = []
-
-        for node in lyricbox:
-            if node.tag == 'br':
-                lyrics.append('\n')
-            if node.tail is not None:
-                lyrics.append(node.tail)
-        self.lyric =  "".join(lyrics).strip()
+        self.lyric = self.parse_lyrics(doc.getroot()) or ''
         return self.lyric
+
+class RateLimiter(object):
+    ### Spaces out calls to the same host, at most rate calls per second
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_call = dict()
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            call_at = max(now, self.next_call.get(host, now))
+            self.next_call[host] = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+class LyricsFetcher(object):
+    ### Fetches the lyrics of many songs concurrently, with an on-disk cache
+    #
+    # Pages are fetched by a pool of threads, rate limited per host and
+    # retried with exponential backoff on network and server errors. Each
+    # answer, including "no lyrics", is cached in cache_dir under the
+    # normalized artist and title, so reruns never fetch a song again.
+    # Songs we gave up on are not cached.
+
+    def __init__(self, cache_dir, workers=8, rate=5.0, retries=3,
+                 backoff=1.0, timeout=10, base_url=LYRICS_BASE_URL):
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.base_url = base_url
+        self.limiter = RateLimiter(rate)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def cache_path(self, song):
+        normalize = lambda s: ' '.join(s.lower().split())
+        key = '%s\t%s' % (normalize(song.artist), normalize(song.title))
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key).hexdigest() + '.txt')
+
+    def download(self, url):
+        # Returns the page at url, None if there is none (e.g. 404).
+        # Raises IOError or httplib.HTTPException once all retries failed.
+        host = urlparse(url).netloc
+        for attempt in xrange(self.retries + 1):
+            self.limiter.wait(host)
+            try:
+                return urllib2.urlopen(url, timeout=self.timeout).read()
+            except urllib2.HTTPError as e:
+                if e.code < 500 and e.code != 429:
+                    return None
+                error = e
+            except (IOError, httplib.HTTPException) as e:
+                # e.g. a timeout, or a dropped connection (BadStatusLine)
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    def fetch_one(self, artist_title):
+        song = Song(*artist_title, base_url=self.base_url)
+        path = self.cache_path(song)
+        if os.path.isfile(path):
+            with open(path) as f:
+                return f.read().decode('utf-8')
+
+        # A song we cannot fetch or parse gets no lyrics rather than
+        # aborting the whole batch, and is tried again on the next run
+        try:
+            page = self.download(song.get_url())
+            lyric = ''
+            if page and page.strip():
+                lyric = Song.parse_lyrics(lxml.html.fromstring(page)) or ''
+        except Exception:
+            return ''
+
+        tmp_path = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            f.write(lyric.encode('utf-8'))
+        os.rename(tmp_path, path)
+        return lyric
+
+    def fetch(self, artist_titles):
+        ### Returns the lyrics of (artist, title) pairs, in the same order
+        pool = ThreadPool(self.workers)
+        try:
+            return pool.map(self.fetch_one, list(artist_titles))
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+
+# Add src directories to our path
+##################################
+
+src_dir = os.path.join(os.getcwd(), 'src')
+msd_src_dir = os.path.join(src_dir, 'MSongsDB', 'PythonSrc')
+msd_year_dir = os.path.join(src_dir, 'MSongsDB', 'Tasks_Demos',
+                            'YearPrediction')
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+if msd_src_dir not in sys.path:
+    sys.path.append(msd_src_dir)
+if msd_year_dir not in sys.path:
+    sys.path.append(msd_year_dir)
+
+## Library and src imports
+###########################
+
+import datetime
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+import beat_aligned_feats as BAF
+import create_synthetic_dataset as SYNTHETIC
+import hdf5_getters as GETTERS
+import hdf5_utils as HDF5
+import hdf5_to_npy as NPY
+import song_files as FILES
+import summary_query as QUERY
+import Util
+
+SCAN_FIELDS = ('tempo', 'year', 'loudness')
+# the artist terms the features build selects its songs by
+CANDIDATE_TERMS = ('alternative rap', 'black', 'east coast rap', 'gangsta',
+                   'hip hop', 'rap', 'soul')
+DB_NAMES = ('track_metadata.db', 'artist_term.db')
+
+def get_dataset_files(dataset_dir):
+    tracks = FILES.build_track_index(os.path.join(dataset_dir, 'data'))
+    return [tracks[track_id] for track_id in sorted(tracks)]
+
+def timed(name, func, filenames, results, mbytes=None):
+    ### Runs func(filenames) and records its speed in files/sec and MB/sec
+    #
+    # mbytes defaults to the size of the files
+    logger = logging.getLogger(__name__)
+    if mbytes is None:
+        mbytes = sum(os.path.getsize(f) for f in filenames) / 1024. / 1024.
+    start = time.time()
+    func(filenames)
+    seconds = time.time() - start
+    results[name] = {
+        'seconds': seconds,
+        'files': len(filenames),
+        'mbytes': mbytes,
+        'files_per_sec': len(filenames) / seconds,
+        'mb_per_sec': mbytes / seconds,
+    }
+    logger.info('%-20s %8.2fs %10.1f files/s %8.2f MB/s', name, seconds,
+                results[name]['files_per_sec'], results[name]['mb_per_sec'])
+
+def bench_features_build(workers, chunksize):
+    def run(filenames):
+        for song_dict in FILES.extract_features(filenames, workers=workers,
+                                                chunksize=chunksize):
+            pass
+    return run
+
+def bench_candidate_selection(db_path):
+    # Selects the track IDs of the songs by artists sharing a term, as the
+    # features build does, from a fresh connection
+    def run(filenames):
+        Util.close_connections()
+        for chunk in FILES.iter_compare_track_ids(db_path, DB_NAMES[0],
+                                                  DB_NAMES[1],
+                                                  CANDIDATE_TERMS):
+            pass
+    return run
+
+def bench_getters(filenames):
+    getters = [getattr(GETTERS, name) for name in dir(GETTERS)
+               if name.startswith('get_')]
+    for filename in filenames:
+        h5 = GETTERS.open_h5_file_read(filename)
+        for getter in getters:
+            getter(h5)
+        h5.close()
+
+def bench_aggregate(summaryfile=False, output=None, bulk=False, profile=None):
+    # Builds an aggregate (or summary) file, in a temporary directory
+    # unless an output path is given, row by row or in bulk
+    fill = HDF5.fill_hdf5_aggregate_file
+    if bulk:
+        fill = HDF5.fill_hdf5_aggregate_file_bulk
+    def run(filenames):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = output or os.path.join(tmp_dir, 'aggregate.h5')
+            HDF5.create_aggregate_file(path, expectedrows=len(filenames),
+                                       summaryfile=summaryfile,
+                                       profile=profile)
+            h5 = HDF5.open_h5_file_append(path)
+            fill(h5, filenames, summaryfile=summaryfile)
+            h5.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+    return run
+
+def bench_summary_parallel(workers):
+    # Builds a summary file from shards filled by worker processes
+    def run(filenames):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            HDF5.create_aggregate_file_parallel(
+                os.path.join(tmp_dir, 'summary.h5'), filenames,
+                summaryfile=True, nworkers=workers)
+        finally:
+            shutil.rmtree(tmp_dir)
+    return run
+
+def bench_summary_scan(summary_path, batch):
+    # Reads tempo, year and loudness of every song of a summary file
+    def run(filenames):
+        h5 = GETTERS.open_h5_file_read(summary_path)
+        try:
+            if batch:
+                for field in SCAN_FIELDS:
+                    GETTERS.read_scalar_batch(h5, field)
+            else:
+                getters = [getattr(GETTERS, 'get_' + f) for f in SCAN_FIELDS]
+                for songidx in xrange(GETTERS.get_num_songs(h5)):
+                    for getter in getters:
+                        getter(h5, songidx)
+        finally:
+            h5.close()
+    return run
+
+def bench_profile_read(aggregate_path):
+    # Reads every array of every song of an aggregate file, one song at
+    # a time as a model would
+    def run(filenames):
+        h5 = GETTERS.open_h5_file_indexed(aggregate_path)
+        try:
+            for songidx in xrange(GETTERS.get_num_songs(h5)):
+                for field in GETTERS.ARRAY_FIELDS:
+                    h5.read_array(field, songidx)
+        finally:
+            h5.close()
+    return run
+
+def bench_profiles(filenames, results):
+    # Size, write and read speed of an aggregate file for each storage
+    # profile
+    for profile in sorted(HDF5.STORAGE_PROFILES):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'aggregate.h5')
+            timed('profile_%s_write' % profile,
+                  bench_aggregate(output=path, bulk=True, profile=profile),
+                  filenames, results)
+            mbytes = os.path.getsize(path) / 1024. / 1024.
+            timed('profile_%s_read' % profile, bench_profile_read(path),
+                  filenames, results, mbytes=mbytes)
+            results['profile_%s_read' % profile]['file_mbytes'] = mbytes
+        finally:
+            shutil.rmtree(tmp_dir)
+
+def bench_timbre_h5(filenames):
+    # A pass over the timbre of every song, one HDF5 file per song
+    for filename in filenames:
+        h5 = GETTERS.open_h5_file_read(filename)
+        GETTERS.get_segments_timbre(h5).sum()
+        h5.close()
+
+def bench_timbre_npy(npy_dir):
+    # The same pass over a flat NumPy export
+    def run(filenames):
+        dataset = NPY.NpyDataset(npy_dir)
+        for track_id, timbre in dataset.iter_field('segments_timbre'):
+            timbre.sum()
+    return run
+
+def bench_filter_fetch(aggregate_path, lazy):
+    # Reads the timbre of the songs of an aggregate file with a tempo
+    # above 150, after reading every song whole or as a lazy view
+    def run(filenames):
+        h5 = GETTERS.open_h5_file_read(aggregate_path)
+        try:
+            for songidx in xrange(GETTERS.get_num_songs(h5)):
+                if lazy:
+                    song = GETTERS.read_song(h5, songidx)
+                else:
+                    song = GETTERS.read_song_record(h5, songidx)
+                if song.tempo > 150:
+                    song.segments_timbre.sum()
+        finally:
+            h5.close()
+    return run
+
+def bench_summary_query(summary_path):
+    # Finds the fast songs of the 2000s in a summary file, in-kernel
+    def run(filenames):
+        h5 = GETTERS.open_h5_file_read(summary_path)
+        try:
+            QUERY.query(h5, ['tempo > 120', '(year >= 2000) & (year < 2010)'],
+                        fields=SCAN_FIELDS)
+        finally:
+            h5.close()
+    return run
+
+def bench_beat_align(aggregate_path, batch):
+    # Beat-aligns chroma, timbre and loudness of every song of an
+    # aggregate file, song by song or all at once
+    def run(filenames):
+        h5 = GETTERS.open_h5_file_read(aggregate_path)
+        try:
+            if batch:
+                BAF.get_btfeats_batch(h5)
+            else:
+                for songidx in xrange(GETTERS.get_num_songs(h5)):
+                    BAF.get_btfeats(h5, songidx=songidx)
+        finally:
+            h5.close()
+    return run
+
+def save_results(results_path, run):
+    # Keep every run, so results can be compared across commits
+    runs = list()
+    if os.path.isfile(results_path):
+        with open(results_path) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(results_path, 'w') as f:
+        json.dump(runs, f, indent=2, sort_keys=True)
+
+def main(dataset_dir, results_path, nsongs, workers, chunksize):
+    logger = logging.getLogger(__name__)
+
+    # Generate the synthetic data set if needed
+    if not os.path.isdir(os.path.join(dataset_dir, 'data')):
+        logger.info('Creating a synthetic data set of %d songs in %s',
+                    nsongs, dataset_dir)
+        SYNTHETIC.create_synthetic_dataset(dataset_dir, nsongs)
+    filenames = get_dataset_files(dataset_dir)
+    logger.info('Benchmarking on %d files', len(filenames))
+
+    results = dict()
+    db_path = os.path.join(dataset_dir, 'AdditionalFiles')
+    mbytes = sum(os.path.getsize(os.path.join(db_path, name))
+                 for name in DB_NAMES) / 1024. / 1024.
+    timed('candidate_selection', bench_candidate_selection(db_path),
+          filenames, results, mbytes=mbytes)
+    timed('getters', bench_getters, filenames, results)
+    timed('features_build', bench_features_build(1, chunksize),
+          filenames, results)
+    if workers != 1:
+        timed('features_build_parallel',
+              bench_features_build(workers, chunksize), filenames, results)
+    timed('aggregate_file', bench_aggregate(), filenames, results)
+    timed('summary_file', bench_aggregate(summaryfile=True),
+          filenames, results)
+    timed('aggregate_file_bulk', bench_aggregate(bulk=True),
+          filenames, results)
+    timed('summary_file_bulk', bench_aggregate(summaryfile=True, bulk=True),
+          filenames, results)
+    if workers != 1:
+        timed('summary_file_parallel', bench_summary_parallel(workers),
+              filenames, results)
+
+    bench_profiles(filenames, results)
+
+    # Timbre passes, per song files against a memory-mapped export
+    timed('timbre_pass_h5', bench_timbre_h5, filenames, results)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        NPY.export_npy(filenames, tmp_dir, fields=['segments_timbre'])
+        mbytes = os.path.getsize(os.path.join(
+            tmp_dir, 'segments_timbre.values.npy')) / 1024. / 1024.
+        timed('timbre_pass_npy', bench_timbre_npy(tmp_dir), filenames,
+              results, mbytes=mbytes)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Filter then fetch over an aggregate file, eager against lazy reads
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        aggregate_path = os.path.join(tmp_dir, 'aggregate.h5')
+        bench_aggregate(output=aggregate_path, bulk=True)(filenames)
+        mbytes = os.path.getsize(aggregate_path) / 1024. / 1024.
+        timed('filter_fetch_record', bench_filter_fetch(aggregate_path, False),
+              filenames, results, mbytes=mbytes)
+        timed('filter_fetch_lazy', bench_filter_fetch(aggregate_path, True),
+              filenames, results, mbytes=mbytes)
+        timed('beat_align_songs', bench_beat_align(aggregate_path, False),
+              filenames, results, mbytes=mbytes)
+        timed('beat_align_batch', bench_beat_align(aggregate_path, True),
+              filenames, results, mbytes=mbytes)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Scans of a summary file, one song per getter call against batches
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        summary_path = os.path.join(tmp_dir, 'summary.h5')
+        bench_aggregate(summaryfile=True, output=summary_path,
+                        bulk=True)(filenames)
+        mbytes = os.path.getsize(summary_path) / 1024. / 1024.
+        timed('summary_scan_getters', bench_summary_scan(summary_path, False),
+              filenames, results, mbytes=mbytes)
+        timed('summary_scan_batch', bench_summary_scan(summary_path, True),
+              filenames, results, mbytes=mbytes)
+        timed('summary_query', bench_summary_query(summary_path),
+              filenames, results, mbytes=mbytes)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    save_results(results_path, {
+        'date': datetime.datetime.now().isoformat(),
+        'host': platform.node(),
+        'dataset': os.path.abspath(dataset_dir),
+        'workers': workers,
+        'results': results,
+    })
+    logger.info('Results saved to %s', results_path)
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the data pipeline on a synthetic MSD data set')
+    parser.add_argument('dataset_dir',
+                        help='synthetic data set directory, created if missing')
+    parser.add_argument('results_path',
+                        help='JSON file the results are appended to')
+    parser.add_argument('--songs', type=int, default=1000,
+                        help='number of songs to create (default: 1000)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='processes for the parallel features build '
+                             '(default: one per core)')
+    parser.add_argument('--chunksize', type=int, default=16)
+    args = parser.parse_args()
+
+    main(args.dataset_dir, args.results_path, args.songs, args.workers,
+         args.chunksize)
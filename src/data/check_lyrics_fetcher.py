@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import sys
+
+# Add src directory to our path
+################################
+
+src_dir = os.path.join(os.getcwd(), 'src')
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+
+## Library and src imports
+###########################
+
+import BaseHTTPServer
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import Util
+
+# Canned lyric pages, keyed by the path Util.Song builds for them. As on
+# LyricWiki the lyrics follow a first node inside the lyricbox.
+LYRICS_PAGE = ('<html><body><div class="lyricbox"><div class="rtMatcher">'
+               '</div>First line<br/>Second line<br/>Third line</div>'
+               '</body></html>')
+CANNED_SONG = ('canned artist', 'canned song')
+CANNED_PATH = '/Canned_Artist:Canned_Song'
+CANNED_LYRICS = 'First line\nSecond line\nThird line'
+# answers 503 this many times, then the lyrics page
+FLAKY_SONG = ('flaky artist', 'flaky song')
+FLAKY_PATH = '/Flaky_Artist:Flaky_Song'
+FLAKY_FAILURES = 2
+# answers 404
+MISSING_SONG = ('missing artist', 'missing song')
+# non-ASCII names, UTF-8 encoded and unicode, percent-encoded in the path
+UTF8_SONG = ('beyonc\xc3\xa9', 'halo')
+UTF8_PATH = '/Beyonc%C3%A9:Halo'
+UNICODE_SONG = (u'\u738b\u83f2', u'\u7ea2\u8c46')
+UNICODE_PATH = '/%E7%8E%8B%E8%8F%B2:%E7%BA%A2%E8%B1%86'
+# closes the connection without answering
+DROPPED_SONG = ('dropped artist', 'dropped song')
+DROPPED_PATH = '/Dropped_Artist:Dropped_Song'
+RETRIES = 3
+
+LYRICS_PATHS = (CANNED_PATH, UTF8_PATH, UNICODE_PATH)
+
+class LyricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ### Serves the canned pages, and logs every request on the server
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((time.time(), self.path))
+            count = sum(1 for t, path in server.requests if path == self.path)
+        if self.path == DROPPED_PATH:
+            self.close_connection = 1
+        elif self.path in LYRICS_PATHS or (self.path == FLAKY_PATH and
+                                           count > FLAKY_FAILURES):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.end_headers()
+            self.wfile.write(LYRICS_PAGE)
+        elif self.path == FLAKY_PATH:
+            self.send_error(503)
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server():
+    ### Starts the stand-in lyrics server on a free localhost port
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), LyricsHandler)
+    server.lock = threading.Lock()
+    server.requests = list()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def count_requests(server, path=None):
+    with server.lock:
+        return sum(1 for t, p in server.requests if path in (None, p))
+
+def check(condition, message):
+    logger = logging.getLogger(__name__)
+    if not condition:
+        raise AssertionError(message)
+    logger.info('ok: %s', message)
+
+def main(rate):
+    server = start_server()
+    base_url = 'http://127.0.0.1:{0:d}/'.format(server.server_address[1])
+    cache_dir = tempfile.mkdtemp()
+    songs = [CANNED_SONG, FLAKY_SONG, MISSING_SONG, UTF8_SONG, UNICODE_SONG,
+             DROPPED_SONG]
+    try:
+        check(Util.Song(*CANNED_SONG, base_url=base_url).get_url() ==
+              base_url + CANNED_PATH[1:], 'songs are fetched from base_url')
+
+        # First run: every page is fetched, the flaky and dropped ones
+        # retried, and the song we give up on does not abort the batch
+        fetcher = Util.LyricsFetcher(cache_dir, workers=3, rate=rate,
+                                     retries=RETRIES, backoff=0.05,
+                                     base_url=base_url)
+        lyrics = fetcher.fetch(songs)
+        check(lyrics == [CANNED_LYRICS, CANNED_LYRICS, '', CANNED_LYRICS,
+                         CANNED_LYRICS, ''],
+              'lyrics of the canned, flaky, missing, non-ASCII and '
+              'dropped pages')
+        check(count_requests(server, FLAKY_PATH) == FLAKY_FAILURES + 1,
+              'the flaky page is retried until it answers')
+        check(count_requests(server, DROPPED_PATH) == RETRIES + 1,
+              'a dropped connection is retried')
+        check(count_requests(server) == FLAKY_FAILURES + RETRIES + 6,
+              'every other page is fetched once')
+
+        # All requests went to the same host, no two closer than the rate
+        times = sorted(t for t, path in server.requests)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        check(min(gaps) >= 0.9 / rate,
+              'requests are spaced by the rate limit (min gap %.3fs)'
+              % min(gaps))
+
+        # Second run: every answer, 404 included, comes from the cache,
+        # only the song we gave up on is fetched again
+        nrequests = count_requests(server)
+        fetcher = Util.LyricsFetcher(cache_dir, workers=3, rate=rate,
+                                     retries=0, base_url=base_url)
+        check(fetcher.fetch(songs) == lyrics and
+              count_requests(server) == nrequests + 1,
+              'a second run is served from the disk cache')
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(
+        description='Check Util.LyricsFetcher against a local stand-in '
+                    'lyrics server')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='requests per second allowed (default: 10)')
+    args = parser.parse_args()
+
+    main(args.rate)
@@ -19,6 +19,22 @@ ARTIST_TERM_DB          = config.get('project', 'artist_term_db')
 TRACK_METADATA_DB       = config.get('project', 'track_metadata_db')
 TARGET_ARTIST_ID        = config.get('artist', 'target_artist_id')
 OUTPUT_PATH             = config.get('output', 'interim')
+# 'columnar' (see Util.export_columnar) or 'pickle' for a pickled DataFrame
+OUTPUT_FORMAT           = config.get('output', 'format')
+# number of extraction processes (0 means one per core) and the number of
+# files handed to a process at a time
+WORKERS                 = config.getint('pipeline', 'workers')
+CHUNKSIZE               = config.getint('pipeline', 'chunksize')
+# number of extracted songs saved per checkpoint, an interrupted run
+# resumes from the last checkpoint
+CHECKPOINT              = config.getint('pipeline', 'checkpoint')
+# comma separated fields and/or field groups to extract (see
+# hdf5_getters.FIELD_GROUPS), every field when empty
+FIELDS                  = [f.strip() for f in
+                           config.get('pipeline', 'fields').split(',')
+                           if f.strip()] or None
+# write a JSON report of per-stage timings, counters and peak RSS
+INSTRUMENT              = config.getboolean('pipeline', 'instrument')
 
 ## Define MSD code and data file paths
 #######################################
@@ -30,6 +46,14 @@ msd_code_path           = os.path.join(os.getcwd(), 'src/MSongsDB')
 # path to the MSD files
 msd_subset_data_path    = os.path.join(msd_subset_path, 'data')
 msd_subset_addf_path    = os.path.join(msd_subset_path, 'AdditionalFiles')
+# persisted track_id -> file path index of the MSD files
+TRACK_INDEX_PATH        = os.path.join(OUTPUT_PATH, 'msd_subset_track_index.pkl')
+# name of the features data set, its build manifest (track_id -> mtime and
+# size of the extracted file) and the checkpoints of an unfinished run
+FEATURES_NAME           = 'msd_subset_song_features_df'
+MANIFEST_PATH           = os.path.join(OUTPUT_PATH, FEATURES_NAME + '_manifest.pkl')
+REPORT_PATH             = os.path.join(OUTPUT_PATH, FEATURES_NAME + '_report.json')
+PARTS_PATH              = os.path.join(OUTPUT_PATH, FEATURES_NAME + '_parts')
 
 # Add src directory to our path
 ################################
@@ -54,59 +78,131 @@ import sqlite3
 import time
 import Util
 from dotenv import find_dotenv, load_dotenv
+from song_files import (TrackIndex, iter_compare_track_ids, find_valid_file,
+                        read_features, extract_features)
+
+INSTR = Util.INSTRUMENTATION
 
 songs_with_features = list()
 
-def export_dataset(df, filename):
-    df.to_pickle(os.path.join(OUTPUT_PATH, filename))
+def export_dataset(df, name, fmt='columnar'):
+    with INSTR.timer('export'):
+        if fmt == 'pickle':
+            df.to_pickle(os.path.join(OUTPUT_PATH, name + '.pkl'))
+        else:
+            Util.export_columnar(df, os.path.join(OUTPUT_PATH, name))
+    INSTR.count('rows_exported', len(df))
+
+def load_dataset(name, fmt='columnar'):
+    # Returns a previously exported data set, or None if there is none.
+    # Array columns are read into memory since a re-export replaces the files.
+    try:
+        if fmt == 'pickle':
+            return pd.read_pickle(os.path.join(OUTPUT_PATH, name + '.pkl'))
+        return Util.load_columnar(os.path.join(OUTPUT_PATH, name), mmap=False)
+    except (IOError, OSError):
+        return None
 
 def get_target_artist_terms():
-    query = "SELECT DISTINCT term FROM artist_term WHERE artist_id = '{0}'".format(TARGET_ARTIST_ID)
-    df = Util.execute_query(msd_subset_addf_path, ARTIST_TERM_DB, query)
+    query = "SELECT DISTINCT term FROM artist_term WHERE artist_id = ?"
+    df = Util.execute_query(msd_subset_addf_path, ARTIST_TERM_DB, query,
+                            params=(TARGET_ARTIST_ID,))
     return set(df['term'])
 
-def get_all_artist_terms(target_artist_terms):
-    query = "SELECT * FROM artist_term"
-    all_artists_terms_df = Util.execute_query(msd_subset_addf_path, ARTIST_TERM_DB, query)
-    mask = all_artists_terms_df['term'].isin(target_artist_terms)
-    return all_artists_terms_df.loc[mask]
-
-def get_all_songs_df():
-    query = "SELECT * FROM songs"
-    songs_df = Util.execute_query(msd_subset_addf_path, TRACK_METADATA_DB, query)
-    return songs_df
-
-def get_compare_songs_df(all_artists_terms_df):
-    query = "SELECT * FROM songs"
-    songs_df = Util.execute_query(msd_subset_addf_path, TRACK_METADATA_DB, query)
-    same_terms_artists_set = set(all_artists_terms_df['artist_id'])
-    mask = songs_df['artist_id'].isin(same_terms_artists_set)
-    return songs_df.loc[mask].copy(deep=True)
-
-def find_valid_file(basedir, track_id, callback=lambda x: x, ext='.h5'):
-    for root, dirs, files in os.walk(basedir):
-        for file in files:
-            if file.endswith(ext) and track_id in file:
-                callback(os.path.join(root, file))
-
-def get_features(filename):
-    # Open the file
-    h5 = GETTERS.open_h5_file_read(filename)
-
-    # Create a dictionary entry and add it to our song list
-    getter_props = (name for name in dir(GETTERS) if name.startswith('get_'))
-    song_dict = dict()
-    for prop in getter_props:
-        key = prop.replace('get_', '')
-        value = getattr(GETTERS, prop)(h5)
-        song_dict[key] = value
+def get_features(filename, fields=None):
+    # Read the song and add it to our song list
+    song_dict = read_features(filename, fields)
     songs_with_features.append(song_dict)
-
-    # Close the file!
-    h5.close()
-
     return song_dict
 
+def file_stat(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime, stat.st_size
+
+def to_pickle_atomic(obj, path):
+    # Write then rename, so an interrupted run never leaves a torn file
+    obj.to_pickle(path + '.tmp')
+    os.rename(path + '.tmp', path)
+
+def fields_key(fields):
+    # How the extracted fields are recorded in the manifest
+    return 'all' if fields is None else ','.join(sorted(fields))
+
+def load_manifest(path):
+    columns = ['mtime', 'size', 'fields']
+    try:
+        manifest = pd.read_pickle(path)
+        if list(manifest.columns) == columns:
+            return manifest
+    except Exception:
+        pass
+    return pd.DataFrame(columns=columns)
+
+def load_extracted_songs(name, fmt='columnar'):
+    ### Returns the songs extracted by earlier runs, indexed by track_id
+    #
+    # That is the last exported data set plus the checkpoints of an
+    # unfinished run, which take precedence.
+    frames = list()
+    df = load_dataset(name, fmt)
+    if df is not None:
+        frames.append(df)
+    if os.path.isdir(PARTS_PATH):
+        for part in sorted(glob.glob(os.path.join(PARTS_PATH, '*.pkl'))):
+            frames.append(pd.read_pickle(part))
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    df = df.drop_duplicates(subset='track_id', keep='last')
+    return df.set_index('track_id', drop=False)
+
+def is_up_to_date(manifest_stats, extracted_ids, track_id, filename,
+                  fields=None):
+    if track_id not in extracted_ids:
+        return False
+    stat = file_stat(filename) + (fields_key(fields),)
+    return manifest_stats.get(track_id) == stat
+
+def extract_with_checkpoints(tracks, manifest, workers=1, chunksize=16,
+                             checkpoint=500, fields=None):
+    ### Extracts (track_id, filename) pairs, checkpointing as it goes
+    #
+    # Every checkpoint songs are saved as a part file, then the manifest
+    # is updated, so a rerun after an interruption skips them.
+    if not os.path.isdir(PARTS_PATH):
+        os.makedirs(PARTS_PATH)
+    nparts = len(glob.glob(os.path.join(PARTS_PATH, '*.pkl')))
+
+    songs = list()
+    stats = list()
+    filenames = [filename for track_id, filename in tracks]
+    features = extract_features(filenames, workers=workers,
+                                chunksize=chunksize, fields=fields)
+    for i, song_dict in enumerate(features):
+        track_id, filename = tracks[i]
+        songs.append(song_dict)
+        stat = file_stat(filename) + (fields_key(fields),)
+        stats.append((track_id,) + stat)
+        if len(songs) < checkpoint and i + 1 < len(tracks):
+            continue
+
+        with INSTR.timer('checkpoint'):
+            part_path = os.path.join(PARTS_PATH, 'part-%05d.pkl' % nparts)
+            to_pickle_atomic(pd.DataFrame(songs), part_path)
+            nparts += 1
+            done = pd.DataFrame(stats,
+                                columns=['track_id', 'mtime', 'size', 'fields'])
+            manifest = pd.concat([manifest, done.set_index('track_id')])
+            manifest = manifest[~manifest.index.duplicated(keep='last')]
+            to_pickle_atomic(manifest, MANIFEST_PATH)
+        songs = list()
+        stats = list()
+    return manifest
+
+def clear_checkpoints():
+    for part in glob.glob(os.path.join(PARTS_PATH, '*.pkl')):
+        os.remove(part)
+
 def get_lyrics(artist_name, song_title):
     song = Util.Song(artist=artist_name, title=song_title)
     lyrics = song.lyricwikia()
@@ -115,6 +211,8 @@ def get_lyrics(artist_name, song_title):
 def main():
     logger = logging.getLogger(__name__)
     logger.info('Making songs_features_df data set from raw data')
+    INSTR.enable(INSTRUMENT)
+    start = time.time()
 
     # Grab terms for the artist ID set in the config file
     # No longer using all terms from the target_artist_terms:
@@ -137,23 +235,65 @@ def main():
         'soul'
     ]
 
-    # Grab terms for all the other artists
-    all_artists_terms_df = get_all_artist_terms(target_artist_terms)
-
-    # Get all songs from the artist_id's we know that share terms with our artist
-    compare_songs_df = get_compare_songs_df(all_artists_terms_df)
-    compare_songs_df = compare_songs_df['track_id'].apply(
-        lambda x: find_valid_file(msd_subset_data_path, x, callback=get_features))
-
-    # Convert list to DataFrame
-    song_features_df = pd.DataFrame(songs_with_features)
+    # Get all songs from the artist_id's that share terms with our artist
+    # and find their files
+    track_index = TrackIndex(msd_subset_data_path, TRACK_INDEX_PATH).load()
+    tracks = list()
+    for chunk in iter_compare_track_ids(msd_subset_addf_path,
+                                        TRACK_METADATA_DB, ARTIST_TERM_DB,
+                                        target_artist_terms):
+        for track_id in chunk:
+            filename = find_valid_file(track_index, track_id)
+            if filename is not None:
+                tracks.append((track_id, filename))
+    track_ids = [t for t, _ in tracks]
+    track_index.save()
+    INSTR.snapshot_rss('select_tracks')
+
+    # Only extract the songs that are new or whose file changed since
+    # the last (possibly interrupted) run
+    manifest = load_manifest(MANIFEST_PATH)
+    manifest_stats = dict(zip(manifest.index,
+                              zip(manifest['mtime'], manifest['size'],
+                                  manifest['fields'])))
+    extracted = load_extracted_songs(FEATURES_NAME, fmt=OUTPUT_FORMAT)
+    extracted_ids = set(extracted.index)
+    todo = [(t, f) for t, f in tracks
+            if not is_up_to_date(manifest_stats, extracted_ids, t, f,
+                                 FIELDS)]
+    logger.info('%d of %d songs up to date, extracting %d (%s workers)',
+                len(tracks) - len(todo), len(tracks), len(todo),
+                WORKERS or 'all')
+    if todo:
+        manifest = extract_with_checkpoints(todo, manifest, workers=WORKERS,
+                                            chunksize=CHUNKSIZE,
+                                            checkpoint=CHECKPOINT,
+                                            fields=FIELDS)
+        extracted = load_extracted_songs(FEATURES_NAME, fmt=OUTPUT_FORMAT)
+
+    INSTR.snapshot_rss('extract')
+
+    # Merge old and new songs into a DataFrame, in track order
+    song_features_df = extracted.loc[track_ids].reset_index(drop=True)
+    if FIELDS is not None:
+        columns = GETTERS.expand_fields(FIELDS + ['track_id'])
+        song_features_df = song_features_df[sorted(columns)]
 
     # Get song lyrics
-    # song_features_df['lyrics'] = song_features_df.apply(
-    #     lambda row: get_lyrics(row['artist_name'], row['title']), axis=1)
+    # fetcher = Util.LyricsFetcher(os.path.join(OUTPUT_PATH, 'lyrics_cache'))
+    # song_features_df['lyrics'] = fetcher.fetch(
+    #     zip(song_features_df['artist_name'], song_features_df['title']))
 
     # Export our DataFrame
-    export_dataset(song_features_df, 'msd_subset_song_features_df.pkl')
+    export_dataset(song_features_df, FEATURES_NAME, fmt=OUTPUT_FORMAT)
+    to_pickle_atomic(manifest.loc[track_ids], MANIFEST_PATH)
+    clear_checkpoints()
+    INSTR.snapshot_rss('export')
+
+    if INSTR.enabled:
+        INSTR.add_time('total', time.time() - start)
+        INSTR.save_report(REPORT_PATH)
+        logger.info('Wrote instrumentation report to %s', REPORT_PATH)
 
     logger.info('Done!')
 
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Finding and reading the MSD song files, for the features build
+# (create_msd_subset_song_features_df.py) and the pipeline benchmark.
+# Everything is passed in, nothing here reads the project config.
+import os
+import sys
+
+# Add src directories to our path
+##################################
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+msd_src_dir = os.path.join(src_dir, 'MSongsDB', 'PythonSrc')
+if src_dir not in sys.path:
+    sys.path.append(src_dir)
+if msd_src_dir not in sys.path:
+    sys.path.append(msd_src_dir)
+
+## Library and src imports
+###########################
+
+import functools
+import hdf5_getters as GETTERS
+import multiprocessing
+import pandas as pd
+import Util
+
+INSTR = Util.INSTRUMENTATION
+
+def path_from_trackid(basedir, track_id, ext='.h5'):
+    # MSD files are stored under letters [2-3-4] of their track ID, i.e.
+    # TRABC1839DQL4H... lives in A/B/C/TRABC1839DQL4H....h5
+    return os.path.join(basedir, track_id[2], track_id[3], track_id[4],
+                        track_id + ext)
+
+def build_track_index(basedir, ext='.h5'):
+    # Maps the track_id of every file in basedir to its path, in one walk
+    tracks = dict()
+    with INSTR.timer('track_index_scan'):
+        for root, dirs, files in os.walk(basedir):
+            for file in files:
+                if file.endswith(ext):
+                    tracks[file[:-len(ext)]] = os.path.join(root, file)
+    INSTR.count('files_scanned', len(tracks))
+    return tracks
+
+class TrackIndex(object):
+    ### Persistent track_id -> file path lookup for an MSD data directory
+    #
+    # The index is built with a single walk over the data directory and
+    # pickled next to our other interim data, so every later lookup (and
+    # every later run) is a dict access instead of a full os.walk.
+
+    def __init__(self, basedir, index_path, ext='.h5'):
+        self.basedir = basedir
+        self.index_path = index_path
+        self.ext = ext
+        self.tracks = None
+        self.rebuilt = False
+        self.dirty = False
+
+    def load(self):
+        # Reuse the pickled index if it was built for this directory,
+        # otherwise (missing, unreadable or built elsewhere) rebuild it
+        try:
+            index = pd.read_pickle(self.index_path)
+            if index.name == self.basedir:
+                self.tracks = index.to_dict()
+                return self
+        except Exception:
+            pass
+        return self.rebuild()
+
+    def rebuild(self):
+        self.tracks = build_track_index(self.basedir, self.ext)
+        self.rebuilt = True
+        self.dirty = True
+        self.save()
+        return self
+
+    def save(self):
+        if not self.dirty:
+            return
+        index = pd.Series(self.tracks, name=self.basedir)
+        index.to_pickle(self.index_path)
+        self.dirty = False
+
+    def get(self, track_id):
+        if self.tracks is None:
+            self.load()
+        path = self.tracks.get(track_id)
+        if path is not None and os.path.isfile(path):
+            return path
+
+        # Stale or missing entry: try the standard MSD layout first, then
+        # fall back to rebuilding the whole index (at most once per run)
+        path = path_from_trackid(self.basedir, track_id, self.ext)
+        if not os.path.isfile(path):
+            if self.rebuilt:
+                return None
+            self.rebuild()
+            path = self.tracks.get(track_id)
+            if path is None:
+                return None
+        self.tracks[track_id] = path
+        self.dirty = True
+        return path
+
+def iter_compare_track_ids(db_path, track_metadata_db, artist_term_db,
+                           target_artist_terms, chunksize=10000):
+    ### Yields chunks of the track IDs of songs by artists sharing a term
+    #
+    # The artist_term database is attached to the track_metadata one, so
+    # the term filter and the join run inside SQLite and only the matching
+    # track IDs are ever loaded, in songs table order.
+    terms = list(target_artist_terms)
+    query = """SELECT track_id FROM songs
+               WHERE artist_id IN (SELECT artist_id FROM terms_db.artist_term
+                                   WHERE term IN ({0}))
+               ORDER BY songs.rowid""".format(', '.join('?' * len(terms)))
+    chunks = Util.iter_query(db_path, track_metadata_db, query,
+                             params=terms, attach={'terms_db': artist_term_db},
+                             chunksize=chunksize)
+    for df in chunks:
+        yield df['track_id'].tolist()
+
+def find_valid_file(track_index, track_id, callback=lambda x: x):
+    # Looks the file up in a loaded TrackIndex, shared by every lookup of
+    # a run; call its save() once done so new entries are kept
+    filename = track_index.get(track_id)
+    if filename is None:
+        return None
+    return callback(filename)
+
+def open_h5_file_read(filename):
+    with INSTR.timer('h5_open'):
+        h5 = GETTERS.open_h5_file_read(filename)
+    INSTR.count('h5_files_opened')
+    if INSTR.enabled:
+        INSTR.count('h5_file_bytes', os.path.getsize(filename))
+    return h5
+
+def read_features(filename, fields=None):
+    # Open the file
+    h5 = open_h5_file_read(filename)
+
+    # Create a dictionary entry for the song, reading all its fields in
+    # one pass, or only the HDF5 nodes of the requested fields. We always
+    # keep the track_id, songs are keyed by it.
+    with INSTR.timer('h5_read'):
+        if fields is None:
+            song_dict = GETTERS.read_song_record(h5).as_dict()
+            song_dict['num_songs'] = GETTERS.get_num_songs(h5)
+        else:
+            song_dict = GETTERS.read_fields(h5, list(fields) + ['track_id'])
+
+    # Close the file!
+    h5.close()
+
+    return song_dict
+
+def read_features_with_stats(filename, fields=None):
+    # For pool workers: also return the worker's instrumentation so far
+    song_dict = read_features(filename, fields)
+    return song_dict, os.getpid(), INSTR.stats()
+
+def extract_features(filenames, workers=1, chunksize=16, fields=None):
+    ### Yields one feature dict per file, in the same order as filenames
+    #
+    # With workers != 1 the files are fanned out over a process pool,
+    # workers=0 uses one process per core. Pool.imap keeps the results
+    # in input order, so the DataFrame matches the serial build.
+    if workers == 1:
+        for filename in filenames:
+            yield read_features(filename, fields)
+        return
+
+    # Workers start with empty instrumentation, and when it is enabled
+    # send theirs back with every song, we keep the last one per worker
+    pool = multiprocessing.Pool(workers or None, initializer=INSTR.reset)
+    if INSTR.enabled:
+        read = functools.partial(read_features_with_stats, fields=fields)
+    else:
+        read = functools.partial(read_features, fields=fields)
+    worker_stats = dict()
+    try:
+        for result in pool.imap(read, filenames, chunksize):
+            if INSTR.enabled:
+                result, pid, worker_stats[pid] = result
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        for stats in worker_stats.values():
+            INSTR.merge(stats)